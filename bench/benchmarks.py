@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Benchmarks for the measurement conversion and FIWARE sending hot paths.
+Uses synthetic fleet data and a local mock FIWARE server instead of IoT-Ticket and FIWARE.
+Reports the throughput and peak memory use of each benchmark and compares them to a saved baseline.
+Exits with status 1 if a benchmark has regressed more than the allowed threshold.
+
+Usage:
+
+    python bench/benchmarks.py [--buses N] [--nodes M] [--seconds T] [--repeat R] [--threshold F] [--save-baseline]
+'''
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+# fleet adds the tool's src directory to the module search path
+import fleet
+from mockFiware import MockFiware
+
+import dataConverter
+import fiware
+
+# default location of the baseline results
+baselineFile = Path( __file__ ).resolve().parent / 'baseline.json'
+
+def main():
+    '''
+    Run the benchmarks as given in the command line arguments.
+    '''
+    parser = argparse.ArgumentParser( description = 'Benchmark the converter and FIWARE sending.' )
+    parser.add_argument( '--buses', type = int, default = 5, help = 'number of buses' )
+    parser.add_argument( '--nodes', type = int, default = 17, help = 'number of datanodes per bus in addition to latitude and longitude' )
+    parser.add_argument( '--seconds', type = int, default = 1800, help = 'length of the measurement period in seconds' )
+    parser.add_argument( '--repeat', type = int, default = 3, help = 'how many times each benchmark is run. The fastest run is reported' )
+    parser.add_argument( '--threshold', type = float, default = 0.25, help = 'allowed relative decrease in throughput or increase in peak memory' )
+    parser.add_argument( '--baseline', type = Path, default = baselineFile, help = 'baseline results file' )
+    parser.add_argument( '--save-baseline', action = 'store_true', help = 'save the results as the new baseline' )
+    args = parser.parse_args()
+
+    params = { 'buses': args.buses, 'nodes': args.nodes, 'seconds': args.seconds }
+    # the server runs in this process so it only counts the requests to keep it from slowing down the benchmarks
+    server = MockFiware( countEntities = False )
+    server.start()
+    _useMock( server )
+    results = {}
+    for name, benchmark in _getBenchmarks( params ):
+        results[ name ] = _run( benchmark, args.repeat )
+        server.reset()
+
+    server.shutdown()
+    _printResults( results )
+    if args.save_baseline:
+        with open( args.baseline, 'w' ) as file:
+            json.dump( { 'params': params, 'results': results }, file, indent = 4 )
+
+        print( f'Baseline saved to {args.baseline}.' )
+        return
+
+    regressions = _compare( params, results, args.baseline, args.threshold )
+    if len( regressions ) > 0:
+        for regression in regressions:
+            print( regression )
+
+        sys.exit( 1 )
+
+def _getBenchmarks( params ):
+    '''
+    Internal function that gets the benchmarks as name and function pairs.
+    A benchmark function does its setup, which is not timed, and returns a function that does the measured work
+    and returns the number of items it processed.
+    '''
+    buses, nodes, seconds = params['buses'], params['nodes'], params['seconds']
+
+    def newData():
+        # conversion modifies the data so each run needs its own
+        return fleet.generate( buses, nodes, seconds )
+
+    def roundTimestamps():
+        data = newData()
+        count = fleet.countMeasurements( data )
+
+        def run():
+            dataConverter._roundTimeStamps( data )
+            return count
+
+        return run
+
+    def joinLocation():
+        data = newData()
+        dataConverter._roundTimeStamps( data )
+
+        def run():
+            for siteData in data.values():
+                dataConverter._joinLocation( siteData['Latitude'], siteData['Longitude'] )
+
+            return sum( len( siteData['Latitude'] ) for siteData in data.values() )
+
+        return run
+
+    def mergeUpdates():
+        data = newData()
+        dataConverter._roundTimeStamps( data )
+        # datanodes prepared the same way as convertToEntityUpdates does before merging them
+        sites = {}
+        for siteId, siteData in data.items():
+            siteNodes = { name: series for name, series in siteData.items() if name not in [ 'Latitude', 'Longitude' ] }
+            siteNodes['location'] = dataConverter._joinLocation( siteData['Latitude'], siteData['Longitude'] )
+            sites[ siteId ] = siteNodes
+
+        def run():
+            for siteId, siteNodes in sites.items():
+                dataConverter._mergeToEntityUpdates( siteId, siteNodes )
+
+            return sum( len( series ) for siteNodes in sites.values() for series in siteNodes.values() )
+
+        return run
+
+    def convert():
+        data = newData()
+        count = fleet.countMeasurements( data )
+
+        def run():
+            dataConverter.convertToEntityUpdates( data )
+            return count
+
+        return run
+
+    def updateOrion():
+        updates = dataConverter.convertToEntityUpdates( newData() )
+
+        def run():
+            fiware._updateOrion( updates )
+            return _countUpdates( updates )
+
+        return run
+
+    def sendWith( strategy ):
+
+        def benchmark():
+            updates = dataConverter.convertToEntityUpdates( newData() )
+            fiware.updateMethod = fiware.updateMethods[ strategy ]
+
+            def run():
+                fiware.sendData( updates )
+                return _countUpdates( updates )
+
+            return run
+
+        return benchmark
+
+    benchmarks = [
+        ( 'roundTimestamps', roundTimestamps ),
+        ( 'joinLocation', joinLocation ),
+        ( 'mergeUpdates', mergeUpdates ),
+        ( 'convert', convert ),
+        ( 'updateOrion', updateOrion )
+    ]
+
+    for strategy in fiware.updateMethods.keys():
+        benchmarks.append(( f'send_{strategy}', sendWith( strategy )))
+
+    return benchmarks
+
+def _run( benchmark, repeat ):
+    '''
+    Internal function that runs a benchmark.
+    Time is measured from repeat runs without tracing memory since tracing slows things down.
+    Peak memory is measured from one more run with tracemalloc.
+    Returns a dictionary with the number of items, the best time, throughput and peak memory.
+    '''
+    times = []
+    for i in range( repeat ):
+        run = benchmark()
+        start = time.perf_counter()
+        items = run()
+        times.append( time.perf_counter() -start )
+
+    run = benchmark()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = min( times )
+    return { 'items': items, 'seconds': round( best, 4 ), 'throughput': round( items /best, 1 ), 'peakMb': round( peak /2**20, 2 ) }
+
+def _compare( params, results, baselineFile, threshold ):
+    '''
+    Internal function that compares the results to the baseline.
+    Returns a list of descriptions of regressions that exceed the threshold.
+    '''
+    try:
+        with open( baselineFile, 'r' ) as file:
+            baseline = json.load( file )
+
+    except FileNotFoundError:
+        print( f'No baseline in {baselineFile}. Save one with --save-baseline.' )
+        return []
+
+    if baseline['params'] != params:
+        print( f'Baseline was made with different parameters {baseline["params"]} so results are not compared.' )
+        return []
+
+    regressions = []
+    for name, result in results.items():
+        base = baseline['results'].get( name )
+        if base == None:
+            continue
+
+        if result['throughput'] < base['throughput'] *( 1 -threshold ):
+            regressions.append( f'{name}: throughput {result["throughput"]}/s is below baseline {base["throughput"]}/s.' )
+
+        # small allocations vary between runs so differences under a megabyte are not counted
+        if result['peakMb'] > base['peakMb'] *( 1 +threshold ) and result['peakMb'] -base['peakMb'] > 1:
+            regressions.append( f'{name}: peak memory {result["peakMb"]} MB is above baseline {base["peakMb"]} MB.' )
+
+    return regressions
+
+def _printResults( results ):
+    '''
+    Internal function that prints the results as a table.
+    '''
+    print( f'{"benchmark":<20}{"items":>10}{"seconds":>10}{"items/s":>14}{"peak MB":>10}' )
+    for name, result in results.items():
+        print( f'{name:<20}{result["items"]:>10}{result["seconds"]:>10.3f}{result["throughput"]:>14.1f}{result["peakMb"]:>10.2f}' )
+
+def _useMock( server ):
+    '''
+    Internal function that makes fiware send its requests to the mock server.
+    Requests are sent one at a time and straight to QuantumLeap so that the results do not depend on the configuration.
+    '''
+    fiware.orionUri = server.getUrl() +'orion/v2/'
+    fiware.qlUri = server.getUrl() +'quantumleap/v2/'
+    fiware.sendToQl = True
+    fiware.qlMultipleNotify = True
+    fiware.updateOrion = False
+    fiware.maxRequests = 1
+
+def _countUpdates( updates ):
+    '''
+    Internal function that counts the entity updates.
+    '''
+    return sum( len( entities ) for entities in updates.values() )
+
+if __name__ == '__main__':
+    main()
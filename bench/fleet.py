@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Generates synthetic measurements for a fleet of buses in the same format as iotTicket.getData returns.
+Each datanode is updated at its own rate with some random jitter in the timestamps. Latitude and longitude
+are updated at the same rate but their timestamps are skewed from each other like in the real data
+so that some of them do not end up in the same second and cannot be joined to a location.
+'''
+
+import random
+import sys
+from pathlib import Path
+
+# the tool's modules are in the src directory
+sys.path.insert( 0, str( Path( __file__ ).resolve().parent.parent / 'src' ))
+
+import dataConverter
+from series import Series
+from utils import s2mrs
+
+# seconds between updates of datanodes that are not listed here are defaultRate
+updateRates = {
+    'Latitude': 1,
+    'Longitude': 1,
+    'speedTCO1': 1,
+    'Speed': 1,
+    'battery power': 1,
+    'battery state of charge': 10,
+    'door status': 30,
+    'Satellites': 10,
+    'Uptime': 10
+}
+defaultRate = 5
+# largest skew in seconds between the latitude and longitude timestamps of the same position
+locationSkew = 0.6
+# datanodes whose values are mapped to other values and the values they can have
+mappedValues = {
+    nodeName: [ int( value ) for value in conversionInfo['mapping'].keys() ]
+    for nodeName, conversionInfo in dataConverter.attributes.items() if 'mapping' in conversionInfo
+}
+
+def getSiteIds( buses ):
+    '''
+    Get the IoT-Ticket site ids for the given number of buses.
+    The configured buses are used first and if more are needed synthetic ones are added to the converter's bus list.
+    '''
+    siteIds = list( dataConverter.busNames.keys() )[ :buses ]
+    number = 1000
+    while len( siteIds ) < buses:
+        siteId = str( 900000 +len( siteIds ))
+        dataConverter.busNames[ siteId ] = number +len( siteIds )
+        siteIds.append( siteId )
+
+    return siteIds
+
+def getNodeNames( nodes ):
+    '''
+    Get the names of the given number of datanodes.
+    Latitude and longitude are always included in addition to them.
+    '''
+    names = [ name for name in dataConverter.attributes.keys() if name != 'location' ][ :nodes ]
+    return names +[ 'Latitude', 'Longitude' ]
+
+def generate( buses, nodes, seconds, begin = 1559289600, seed = 0, rateScale = 1 ):
+    '''
+    Generate measurements of the given number of buses and datanodes for a period of the given length in seconds starting from begin.
+    Begin is a unix timestamp in seconds. Seed makes the result reproducible.
+    RateScale multiplies how often the datanodes are updated.
+    Returns a dictionary with site id as key and a dictionary of datanode name and Series pairs as value.
+    '''
+    rand = random.Random( seed )
+    data = {}
+    for siteId in getSiteIds( buses ):
+        siteData = {}
+        data[ siteId ] = siteData
+        for name in getNodeNames( nodes ):
+            if name not in [ 'Latitude', 'Longitude' ]:
+                siteData[ name ] = _generateNode( rand, name, begin, seconds, rateScale )
+
+        siteData['Latitude'], siteData['Longitude'] = _generateLocation( rand, begin, seconds, rateScale )
+
+    return data
+
+def generateSeries( siteId, name, begin, seconds, rateScale = 1 ):
+    '''
+    Generate the measurements of one datanode of a site for a period of the given length in seconds starting from begin.
+    The result depends only on the parameters so latitude and longitude generated separately still match each other.
+    '''
+    if name in [ 'Latitude', 'Longitude' ]:
+        # both are generated from the same seed
+        lat, lon = _generateLocation( random.Random( f'{siteId}-location-{begin}-{seconds}' ), begin, seconds, rateScale )
+        return lat if name == 'Latitude' else lon
+
+    return _generateNode( random.Random( f'{siteId}-{name}-{begin}-{seconds}' ), name, begin, seconds, rateScale )
+
+def countMeasurements( data ):
+    '''
+    Get the total number of measurements in data.
+    '''
+    return sum( len( series ) for siteData in data.values() for series in siteData.values() )
+
+def _generateNode( rand, name, begin, seconds, rateScale ):
+    '''
+    Internal function that generates the measurements of one datanode.
+    '''
+    rate = updateRates.get( name, defaultRate ) /rateScale
+    series = Series()
+    value = rand.uniform( 0, 100 )
+    # the datanodes of a bus are not updated at the same moment
+    ts = begin +rand.uniform( 0, rate )
+    while ts < begin +seconds:
+        if name in mappedValues:
+            series.append( s2mrs( ts ), rand.choice( mappedValues[ name ] ))
+
+        else:
+            # a random walk looks more like a real measurement than independent values
+            value = max( value +rand.gauss( 0, 1 ), 0.0 )
+            series.append( s2mrs( ts ), round( value, 3 ))
+
+        ts += rate *rand.uniform( 0.9, 1.1 )
+
+    return series
+
+def _generateLocation( rand, begin, seconds, rateScale ):
+    '''
+    Internal function that generates latitude and longitude series of a bus moving around Tampere.
+    '''
+    lat = Series()
+    lon = Series()
+    latValue = 61.4978 +rand.uniform( -0.05, 0.05 )
+    lonValue = 23.7610 +rand.uniform( -0.1, 0.1 )
+    ts = begin +rand.uniform( 0, 1 )
+    while ts < begin +seconds:
+        latValue += rand.gauss( 0, 0.0001 )
+        lonValue += rand.gauss( 0, 0.0002 )
+        lat.append( s2mrs( ts ), round( latValue, 6 ))
+        lon.append( s2mrs( ts +rand.uniform( 0, locationSkew /rateScale )), round( lonValue, 6 ))
+        ts += rand.uniform( 0.9, 1.1 ) /rateScale
+
+    return lat, lon
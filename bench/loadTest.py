@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Load test that runs the whole tool against local mock IoT-Ticket and FIWARE servers.
+Collects a historical period for a synthetic fleet and reports how many measurements per second were collected
+and the latencies of the fetch, convert and send stages.
+
+Usage:
+
+    python bench/loadTest.py [--buses N] [--hours H] [--mode MODE] [--strategy STRATEGY] ...
+
+See python bench/loadTest.py --help for all options.
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# the tool's root directory
+appDir = Path( __file__ ).resolve().parent.parent
+# start of the collected period. The measurements are synthetic so any past time will do
+startDate = datetime( 2019, 5, 31, 8 )
+
+def main():
+    '''
+    Run the load test as given in the command line arguments.
+    '''
+    parser = argparse.ArgumentParser( description = 'Load test the tool with mock IoT-Ticket and FIWARE servers.' )
+    parser.add_argument( '--buses', type = int, default = 5, help = 'number of buses' )
+    parser.add_argument( '--nodes', type = int, default = 17, help = 'number of datanodes per bus in addition to latitude and longitude' )
+    parser.add_argument( '--rate-scale', type = float, default = 1, help = 'multiplier for how often datanodes are updated' )
+    parser.add_argument( '--hours', type = float, default = 6, help = 'length of the collected period in hours' )
+    parser.add_argument( '--mode', default = 'sequential', help = 'collector mode' )
+    parser.add_argument( '--strategy', default = 'medium', help = 'FIWARE update strategy' )
+    parser.add_argument( '--iot-requests', type = int, default = 8, help = 'maximum concurrent requests to IoT-Ticket' )
+    parser.add_argument( '--fiware-requests', type = int, default = 4, help = 'maximum concurrent requests to FIWARE' )
+    parser.add_argument( '--iot-latency', type = float, default = 0.05, help = 'mean latency of IoT-Ticket requests in seconds' )
+    parser.add_argument( '--iot-error-rate', type = float, default = 0, help = 'fraction of IoT-Ticket requests that fail' )
+    parser.add_argument( '--fiware-latency', type = float, default = 0.02, help = 'mean latency of FIWARE requests in seconds' )
+    parser.add_argument( '--fiware-error-rate', type = float, default = 0, help = 'fraction of FIWARE requests that fail' )
+    parser.add_argument( '--record', type = Path, help = 'file where the entity updates received by the FIWARE server are written' )
+    args = parser.parse_args()
+
+    confDir = Path( tempfile.mkdtemp( prefix = 'loadtest-conf-' ))
+    # the tool's modules read their configuration when imported so the configuration has to be ready before importing them
+    os.environ['COLLECTOR_CONF_DIR'] = str( confDir )
+    sys.path.insert( 0, str( appDir / 'src' ))
+    _writeCollectionConf( confDir, args )
+    from mockIotTicket import MockIotTicket
+    from mockFiware import MockFiware
+
+    iotTicketServer = MockIotTicket( latency = args.iot_latency, errorRate = args.iot_error_rate, nodes = args.nodes, rateScale = args.rate_scale )
+    fiwareServer = MockFiware( latency = args.fiware_latency, errorRate = args.fiware_error_rate, recordFile = args.record )
+    iotTicketServer.start()
+    fiwareServer.start()
+    _writeServerConf( confDir, args, iotTicketServer.getUrl(), fiwareServer.getUrl() )
+
+    import main as collectorMain
+    timer = _StageTimer()
+    timer.install()
+    start = time.perf_counter()
+    collectorMain.main()
+    elapsed = time.perf_counter() -start
+    iotTicketServer.shutdown()
+    fiwareServer.shutdown()
+    fiwareServer.server_close()
+    _printReport( args, elapsed, iotTicketServer, fiwareServer, timer )
+
+def _writeCollectionConf( confDir, args ):
+    '''
+    Internal function that writes the configuration files for what is collected to confDir.
+    The tool's own configuration is used as a base.
+    '''
+    endDate = startDate +timedelta( hours = args.hours )
+    collector = { 'startDate': startDate.isoformat(), 'endDate': endDate.isoformat(), 'mode': args.mode, 'use_checkpoints': False }
+    _saveConf( confDir, 'collector.json', collector )
+    converter = _loadConf( 'converter.json' )
+    # add synthetic buses if there are not enough configured ones
+    siteIds = list( converter['busIDs'].keys() )[ :args.buses ]
+    converter['busIDs'] = { siteId: converter['busIDs'][ siteId ] for siteId in siteIds }
+    for index in range( len( siteIds ), args.buses ):
+        converter['busIDs'][ str( 900000 +index ) ] = 1000 +index
+
+    _saveConf( confDir, 'converter.json', converter )
+    loggingConf = _loadConf( 'logging.json' )
+    # keep the load test's logs out of the tool's logs
+    loggingConf['log_dir'] = str( confDir / 'logs' )
+    _saveConf( confDir, 'logging.json', loggingConf )
+
+def _writeServerConf( confDir, args, iotTicketUrl, fiwareUrl ):
+    '''
+    Internal function that writes the configuration files for connecting to the mock servers to confDir.
+    '''
+    iotTicket = _loadConf( 'iot-ticket.json' )
+    # the datanodes of the mock server are not saved to the tool's state
+    iotTicket.update( { 'url': iotTicketUrl +'rest/v1/', 'username': 'test', 'password': 'test', 'max_concurrent_requests': args.iot_requests,
+                        'datanode_cache': False } )
+    # retry quickly so that simulated errors do not dominate the results
+    iotTicket['retry'] = { 'base_delay': 0.1, 'max_delay': 2, 'reset_timeout': 2 }
+    _saveConf( confDir, 'iot-ticket.json', iotTicket )
+
+    fiware = _loadConf( 'fiware.json' )
+    fiware.update( { 'orion_URL': fiwareUrl +'orion/v2/', 'quantumleap_URL': fiwareUrl +'quantumleap/v2/', 'update_strategy': args.strategy,
+                     'max_concurrent_requests': args.fiware_requests, 'send_to_ql': True, 'ql_multiple_notify': True } )
+    fiware['retry'] = { 'orion': iotTicket['retry'], 'quantumleap': iotTicket['retry'] }
+    _saveConf( confDir, 'fiware.json', fiware )
+
+def _loadConf( fileName ):
+    '''
+    Internal function that loads a configuration file of the tool.
+    '''
+    with open( appDir / 'conf' / fileName, 'r' ) as file:
+        return json.load( file )
+
+def _saveConf( confDir, fileName, conf ):
+    '''
+    Internal function that saves a configuration file to confDir.
+    '''
+    with open( confDir / fileName, 'w' ) as file:
+        json.dump( conf, file, indent = 4 )
+
+class _StageTimer():
+    '''
+    Internal class that measures how long the fetch, convert and send stages take in the tool.
+    '''
+
+    def __init__(self):
+        self.times = defaultdict( list )
+        self._lock = threading.Lock()
+
+    def install(self):
+        '''
+        Replace the stage functions of the tool with versions that measure their duration.
+        Only works for stages run in this process. Backfill workers run in their own processes.
+        '''
+        import iotTicket
+        import dataConverter
+        import fiware
+        iotTicket.getData = self._wrap( 'fetch', iotTicket.getData )
+        iotTicket.getDataAsync = self._wrapAsync( 'fetch', iotTicket.getDataAsync )
+        dataConverter.convertToEntityUpdates = self._wrap( 'convert', dataConverter.convertToEntityUpdates )
+        fiware.sendData = self._wrap( 'send', fiware.sendData )
+
+    def _wrap(self, stage, function ):
+
+        def timed( *args, **kwargs ):
+            start = time.perf_counter()
+            try:
+                return function( *args, **kwargs )
+
+            finally:
+                self._add( stage, time.perf_counter() -start )
+
+        return timed
+
+    def _wrapAsync(self, stage, function ):
+
+        async def timed( *args, **kwargs ):
+            start = time.perf_counter()
+            try:
+                return await function( *args, **kwargs )
+
+            finally:
+                self._add( stage, time.perf_counter() -start )
+
+        return timed
+
+    def _add(self, stage, duration ):
+        with self._lock:
+            self.times[ stage ].append( duration )
+
+def _printReport( args, elapsed, iotTicketServer, fiwareServer, timer ):
+    '''
+    Internal function that prints the load test results.
+    '''
+    updates = sum( fiwareServer.entities.values() )
+    print()
+    print( f'Collected {args.hours} hours of {args.buses} buses in {args.mode} mode in {elapsed:.1f} seconds.' )
+    print( f'IoT-Ticket: {iotTicketServer.requests} requests, {iotTicketServer.errors} failed, {iotTicketServer.measurements} measurements, '
+           f'{iotTicketServer.measurements /elapsed:.0f} measurements/s.' )
+    print( f'FIWARE: {fiwareServer.updateRequests} update requests, {fiwareServer.errors} failed, {updates} entity updates, '
+           f'{fiwareServer.bodyBytes /2**20:.1f} MB, {updates /elapsed:.0f} updates/s.' )
+    if len( timer.times ) == 0:
+        print( 'No stage latencies since the stages were run in other processes.' )
+        return
+
+    print( f'{"stage":<10}{"count":>8}{"mean s":>10}{"p50 s":>10}{"p95 s":>10}{"max s":>10}' )
+    for stage in [ 'fetch', 'convert', 'send' ]:
+        times = sorted( timer.times[ stage ] )
+        if len( times ) == 0:
+            continue
+
+        print( f'{stage:<10}{len( times ):>8}{sum( times ) /len( times ):>10.3f}{_percentile( times, 0.5 ):>10.3f}'
+               f'{_percentile( times, 0.95 ):>10.3f}{times[-1]:>10.3f}' )
+
+def _percentile( times, fraction ):
+    '''
+    Internal function that gets the given percentile from sorted times.
+    '''
+    return times[ min( int( len( times ) *fraction ), len( times ) -1 ) ]
+
+if __name__ == '__main__':
+    main()
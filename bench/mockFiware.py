@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Local mock FIWARE server that stands in for both Orion and QuantumLeap.
+Accepts Orion batch updates (op/update), QuantumLeap notifications (notify), entity creation and subscriptions.
+Keeps count of what it has received and can also write every received update to a file.
+Orion is expected under orion/v2/ and QuantumLeap under quantumleap/v2/.
+'''
+
+import gzip
+import json
+from collections import Counter
+
+from mockServer import MockServer, MockHandler
+
+class MockFiware( MockServer ):
+    '''
+    The mock FIWARE server.
+    '''
+
+    def __init__(self, port = 0, latency = 0, errorRate = 0, recordFile = None, countEntities = True ):
+        '''
+        Create the server. RecordFile is an optional path of a file where each received entity update is written as a JSON line.
+        If countEntities is False request bodies are not parsed and only requests and bytes are counted.
+        '''
+        super().__init__( _FiwareHandler, port, latency, errorRate )
+        self.countEntities = countEntities
+        # number of update requests and their body bytes as sent i.e. possibly compressed
+        self.updateRequests = 0
+        self.bodyBytes = 0
+        # number of received entity updates by entity id
+        self.entities = Counter()
+        self.recordFile = None
+        if recordFile != None:
+            self.recordFile = open( recordFile, 'w' )
+
+    def reset(self):
+        '''
+        Reset the counts.
+        '''
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.updateRequests = 0
+            self.bodyBytes = 0
+            self.entities = Counter()
+
+    def server_close(self):
+        super().server_close()
+        if self.recordFile != None:
+            self.recordFile.close()
+
+class _FiwareHandler( MockHandler ):
+    '''
+    Internal request handler of the mock FIWARE server.
+    '''
+
+    def do_GET(self):
+        if not self.simulate():
+            return
+
+        # no entities exist so that the tool creates them
+        self.sendJson( { 'error': 'NotFound' }, 404 )
+
+    def do_POST(self):
+        body = self.readBody()
+        if not self.simulate():
+            return
+
+        if self.path.endswith( 'op/update' ) or self.path.endswith( 'notify' ):
+            self._receiveUpdates( body )
+            self.sendStatus( 204 if self.path.endswith( 'op/update' ) else 200 )
+
+        elif self.path.endswith( 'subscriptions' ):
+            self.sendStatus( 201, { 'Location': '/v2/subscriptions/mock' } )
+
+        else:
+            # entity creation
+            self.sendStatus( 201 )
+
+    def _receiveUpdates(self, body ):
+        '''
+        Count and record the entity updates of an update request.
+        '''
+        with self.server.lock:
+            self.server.updateRequests += 1
+            self.server.bodyBytes += len( body )
+
+        if not self.server.countEntities and self.server.recordFile == None:
+            return
+
+        if self.headers.get( 'Content-Encoding' ) == 'gzip':
+            body = gzip.decompress( body )
+
+        payload = json.loads( body.decode( 'utf-8' ))
+        entities = payload.get( 'entities', payload.get( 'data', [] ))
+        with self.server.lock:
+            for entity in entities:
+                self.server.entities[ entity['id'] ] += 1
+
+            if self.server.recordFile != None:
+                for entity in entities:
+                    self.server.recordFile.write( json.dumps( entity ) +'\n' )
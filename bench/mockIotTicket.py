@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Local mock IoT-Ticket server.
+Serves the datanodes of any site (sites/{id}/datanodes) and their measurements (datanodes/{site}_{index}/processdata)
+generated with the fleet module. The measurements of a period are always the same for the same request.
+The datanodes can be requested with their latest measurements (expand=processData) which change every second.
+'''
+
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+
+import fleet
+from mockServer import MockServer, MockHandler
+from utils import mrs2s
+
+class MockIotTicket( MockServer ):
+    '''
+    The mock IoT-Ticket server.
+    '''
+
+    def __init__(self, port = 0, latency = 0, errorRate = 0, nodes = 17, rateScale = 1 ):
+        '''
+        Create the server.
+        Nodes is the number of datanodes each site has in addition to latitude and longitude.
+        RateScale multiplies how often the datanodes are updated i.e. the volume of measurements.
+        '''
+        super().__init__( _IotTicketHandler, port, latency, errorRate )
+        self.nodeNames = fleet.getNodeNames( nodes )
+        self.rateScale = rateScale
+        # number of measurements served
+        self.measurements = 0
+
+class _IotTicketHandler( MockHandler ):
+    '''
+    Internal request handler of the mock IoT-Ticket server.
+    '''
+
+    def do_GET(self):
+        if not self.simulate():
+            return
+
+        url = urlparse( self.path )
+        params = parse_qs( url.query )
+        match = re.search( r'/sites/([^/]+)/datanodes$', url.path )
+        if match:
+            self._sendDataNodes( match.group( 1 ), 'processData' in params.get( 'expand', [ '' ] )[0] )
+            return
+
+        match = re.search( r'/datanodes/([^/]+)_(\d+)/processdata$', url.path )
+        if match:
+            self._sendProcessData( match.group( 1 ), int( match.group( 2 )), params )
+            return
+
+        self.sendJson( { 'description': 'Not found' }, 404 )
+
+    def _sendDataNodes(self, siteId, latest ):
+        '''
+        Send the datanodes of a site.
+        If latest is true the latest measurement of each datanode is included as with expand=processData.
+        '''
+        items = [ { 'name': name, 'href': f'{self.server.getUrl()}rest/v1/datanodes/{siteId}_{index}' }
+                  for index, name in enumerate( self.server.nodeNames ) ]
+        if latest:
+            # the latest measurement is the last one generated for the previous minute
+            begin = int( time.time() ) -60
+            for item in items:
+                series = fleet.generateSeries( siteId, item['name'], begin, 60, self.server.rateScale )
+                item['processData'] = { 'items': [ { 'ts': ts, 'v': value } for ts, value in series ][ -1: ] }
+
+            with self.server.lock:
+                self.server.measurements += len( items )
+
+        self.sendJson( { 'items': items, 'offset': 0, 'limit': len( items ), 'fullSize': len( items ) } )
+
+    def _sendProcessData(self, siteId, index, params ):
+        '''
+        Send the measurements of a datanode between the begin and end given in the request parameters.
+        '''
+        begin = int( params['begin'][0] )
+        end = int( params['end'][0] )
+        limit = int( params.get( 'limit', [ 10000 ] )[0] )
+        series = fleet.generateSeries( siteId, self.server.nodeNames[ index ], mrs2s( begin ), mrs2s( end -begin ), self.server.rateScale )
+        items = [ { 'ts': ts, 'v': value } for ts, value in series ][ :limit ]
+        with self.server.lock:
+            self.server.measurements += len( items )
+
+        self.sendJson( { 'items': items, 'offset': 0, 'limit': limit, 'fullSize': len( series ) } )
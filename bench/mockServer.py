@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Base classes for the local mock servers that stand in for IoT-Ticket and FIWARE in benchmarks and load tests.
+'''
+
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class MockServer( ThreadingHTTPServer ):
+    '''
+    HTTP server listening on localhost in a background thread.
+    Every request can be delayed by a random latency and fail with HTTP 500 at the given error rate.
+    '''
+    daemon_threads = True
+
+    def __init__(self, handlerClass, port = 0, latency = 0, errorRate = 0 ):
+        '''
+        Create the server. With port 0 a free port is chosen.
+        Latency is the mean delay in seconds added to each request and errorRate the fraction of requests that fail.
+        '''
+        super().__init__( ( '127.0.0.1', port ), handlerClass )
+        self.latency = latency
+        self.errorRate = errorRate
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''
+        Start serving in a background thread.
+        '''
+        threading.Thread( target = self.serve_forever, name = type( self ).__name__, daemon = True ).start()
+
+    def getUrl(self):
+        '''
+        Get the base URL of the server.
+        '''
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+class MockHandler( BaseHTTPRequestHandler ):
+    '''
+    Base request handler for the mock servers.
+    '''
+    # keep connections open like a real server does
+    protocol_version = 'HTTP/1.1'
+
+    def simulate(self):
+        '''
+        Count the request, wait for the simulated latency and fail the request if it is chosen to fail.
+        Returns False if the request failed and was already answered.
+        '''
+        with self.server.lock:
+            self.server.requests += 1
+
+        if self.server.latency > 0:
+            # exponential distribution gives occasional slow requests like a real server
+            time.sleep( random.expovariate( 1 /self.server.latency ))
+
+        if random.random() < self.server.errorRate:
+            with self.server.lock:
+                self.server.errors += 1
+
+            self.sendStatus( 500 )
+            return False
+
+        return True
+
+    def readBody(self):
+        '''
+        Read the request body.
+        '''
+        return self.rfile.read( int( self.headers.get( 'Content-Length', 0 )))
+
+    def sendJson(self, content, status = 200 ):
+        '''
+        Send the content as a JSON response.
+        '''
+        body = json.dumps( content ).encode( 'utf-8' )
+        self.send_response( status )
+        self.send_header( 'Content-Type', 'application/json' )
+        self.send_header( 'Content-Length', str( len( body )))
+        self.end_headers()
+        self.wfile.write( body )
+
+    def sendStatus(self, status, headers = {} ):
+        '''
+        Send a response without a body.
+        '''
+        self.send_response( status )
+        for name, value in headers.items():
+            self.send_header( name, value )
+
+        self.send_header( 'Content-Length', '0' )
+        self.end_headers()
+
+    def log_message(self, format, *args ):
+        # do not log every request
+        pass
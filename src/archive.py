@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Archive of measurements fetched from IoT-Ticket.
+The measurements of each collection period are saved as they were returned by iotTicket.getData to their own file
+so that they can later be replayed without fetching them again.
+When buses are collected separately each bus' measurements of a period are saved to their own file with the bus' key
+in the file name and the files of the same period are merged when it is loaded.
+A file is gzip compressed and starts with a magic string. It then has for each site a length prefixed JSON header describing
+the site's datanodes followed by the timestamp and value columns of the datanodes as raw little endian arrays.
+Values which are not all integers or all floats are saved as a JSON list.
+'''
+
+import gzip
+import json
+import os
+import struct
+import sys
+from array import array
+
+from series import Series
+
+# identifies an archive file and its format version
+_magic = b'EBA1'
+# length of a site header
+_length = struct.Struct( '>I' )
+
+def save( directory, begin, end, data, key = None ):
+    '''
+    Save the measurements of the period between begin and end to the archive in the given directory.
+    Data is a dictionary returned by iotTicket.getData. Key is added to the file name when the measurements
+    are only part of those of the period for example the measurements of one bus.
+    The file is first written with a temporary name so that there never is a partially written archive file.
+    '''
+    directory.mkdir( parents = True, exist_ok = True )
+    path = _windowPath( directory, begin, end, key )
+    tempPath = path.with_suffix( '.tmp' )
+    with gzip.open( tempPath, 'wb', compresslevel = 6 ) as file:
+        file.write( _magic )
+        for siteId, nodes in data.items():
+            _writeSite( file, siteId, nodes )
+
+    os.replace( str( tempPath ), str( path ))
+
+def load( directory, begin, end ):
+    '''
+    Load the measurements of the period between begin and end from the archive in the given directory.
+    The measurements of all files of the period are combined.
+    Returns a dictionary in the same format as iotTicket.getData.
+    '''
+    data = {}
+    paths = sorted( directory.glob( f'{begin}_{end}_*.window' ))
+    path = _windowPath( directory, begin, end )
+    if path.exists():
+        paths.insert( 0, path )
+
+    for path in paths:
+        _loadFile( path, data )
+
+    return data
+
+def _loadFile( path, data ):
+    '''
+    Internal function that loads the measurements of an archive file to the data dictionary.
+    '''
+    with gzip.open( path, 'rb' ) as file:
+        if file.read( len( _magic )) != _magic:
+            raise ValueError( f'{path} is not a measurement archive file.' )
+
+        while True:
+            length = file.read( _length.size )
+            if len( length ) == 0:
+                break
+
+            header = json.loads( file.read( _length.unpack( length )[0] ).decode( 'utf-8' ))
+            siteData = {}
+            data[ header['site'] ] = siteData
+            for node in header['nodes']:
+                timestamps = _bytesToArray( 'q', file.read( node['count'] *8 ))
+                valueBytes = file.read( node['valueBytes'] )
+                values = None
+                if node['values'] == 'json':
+                    values = json.loads( valueBytes.decode( 'utf-8' ))
+
+                elif node['values'] != None:
+                    values = _bytesToArray( node['values'], valueBytes )
+
+                siteData[ node['name'] ] = Series.fromColumns( timestamps, values )
+
+def listWindows( directory ):
+    '''
+    Get the begin and end tuples of the periods saved to the archive in the given directory in ascending order.
+    '''
+    windows = set() # a period can have a file for each bus
+    for path in directory.glob( '*.window' ):
+        begin, end = path.stem.split( '_' )[ :2 ]
+        windows.add(( int( begin ), int( end )))
+
+    return sorted( windows )
+
+def _writeSite( file, siteId, nodes ):
+    '''
+    Internal function that writes the header and measurements of a site.
+    '''
+    meta = [] # header info of each datanode
+    columns = [] # the datanode's timestamp and value columns as bytes
+    for name, series in nodes.items():
+        values = series.values
+        valueType = None
+        valueBytes = b''
+        if type( values ) == list:
+            valueType = 'json'
+            valueBytes = json.dumps( values ).encode( 'utf-8' )
+
+        elif values != None:
+            valueType = values.typecode
+            valueBytes = _arrayToBytes( values )
+
+        meta.append( { 'name': name, 'count': len( series ), 'values': valueType, 'valueBytes': len( valueBytes ) } )
+        columns.append( _arrayToBytes( series.timestamps ))
+        columns.append( valueBytes )
+
+    header = json.dumps( { 'site': siteId, 'nodes': meta } ).encode( 'utf-8' )
+    file.write( _length.pack( len( header )) +header )
+    for column in columns:
+        file.write( column )
+
+def _arrayToBytes( column ):
+    '''
+    Internal function that gets the bytes of an array in little endian byte order.
+    '''
+    if sys.byteorder == 'big':
+        column = array( column.typecode, column )
+        column.byteswap()
+
+    return column.tobytes()
+
+def _bytesToArray( typecode, data ):
+    '''
+    Internal function that creates an array of the given type from little endian bytes.
+    '''
+    column = array( typecode )
+    column.frombytes( data )
+    if sys.byteorder == 'big':
+        column.byteswap()
+
+    return column
+
+def _windowPath( directory, begin, end, key = None ):
+    '''
+    Internal function that gets the path of the archive file for the period between begin and end and the optional key.
+    '''
+    if key == None:
+        return directory / f'{begin}_{end}.window'
+
+    return directory / f'{begin}_{end}_{key}.window'
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Contains the AdaptiveBatcher class used by the adaptive FIWARE update strategy to decide how many updates are sent in one request.
+'''
+
+import json
+import threading
+import logging
+
+# logger for module
+log = logging.getLogger( __name__ )
+
+class AdaptiveBatcher():
+    '''
+    Keeps track of how many entity updates should be sent in one request.
+    The number of updates is limited so that the request body stays under a target size and the request is
+    answered within a target time. When requests are too large (HTTP 413) or time out the batch size is halved.
+    When requests are answered quickly the batch size is grown back.
+    The body size of an update is estimated from the previously sent requests.
+    Can be used from multiple threads.
+    '''
+
+    def __init__(self, targetBytes = 1000000, targetLatency = 2.0, minBatch = 1, maxBatch = 5000, initialBatch = 600 ):
+        '''
+        Create batcher.
+        TargetBytes is the preferred maximum request body size in bytes.
+        TargetLatency is the preferred maximum time in seconds for a request.
+        MinBatch and maxBatch are the limits for the number of updates in a request and initialBatch is where we start.
+        '''
+        self.targetBytes = targetBytes
+        self.targetLatency = targetLatency
+        self.minBatch = minBatch
+        self.maxBatch = maxBatch
+        self.batchSize = min( max( initialBatch, minBatch ), maxBatch )
+        # estimated average body size of one update in bytes None until we have something to base it on
+        self.updateBytes = None
+        self._lock = threading.Lock()
+
+    def getBatch(self, entities, start ):
+        '''
+        Get the next batch of updates to send from entities starting from index start.
+        '''
+        with self._lock:
+            if self.updateBytes == None:
+                # nothing sent yet so estimate from the first update
+                self.updateBytes = max( len( json.dumps( entities[ start ] )), 1 )
+
+            size = min( self.batchSize, max( self.targetBytes //self.updateBytes, self.minBatch ))
+
+        return entities[ start: start +size ]
+
+    def sent(self, count, bodyBytes, elapsed ):
+        '''
+        Tell that a batch of count updates whose body was bodyBytes long was sent successfully in elapsed seconds.
+        '''
+        with self._lock:
+            # moving average of the update size so that one unusual batch does not change it too much
+            self.updateBytes = max( round( 0.7 *self.updateBytes +0.3 *bodyBytes /count ), 1 )
+            if elapsed > self.targetLatency:
+                # too slow so decrease in proportion to how much we went over
+                newSize = int( count *self.targetLatency /elapsed )
+
+            elif elapsed < self.targetLatency /2 and count >= self.batchSize:
+                # fast and the batch was full so there is room to grow
+                newSize = self.batchSize +max( self.batchSize //4, 1 )
+
+            else:
+                return
+
+            self._setBatchSize( newSize )
+
+    def tooLarge(self, count, bodyBytes ):
+        '''
+        Tell that a batch of count updates with body of bodyBytes was rejected for being too large.
+        '''
+        with self._lock:
+            # the server's limit is less than this so aim under half of it from now on
+            self.targetBytes = min( self.targetBytes, max( bodyBytes //2, 1 ))
+            self._setBatchSize( count //2 )
+
+    def timedOut(self, count ):
+        '''
+        Tell that a batch of count updates timed out.
+        '''
+        with self._lock:
+            self._setBatchSize( count //2 )
+
+    def _setBatchSize(self, size ):
+        '''
+        Internal method for changing the batch size within the limits.
+        '''
+        size = min( max( size, self.minBatch ), self.maxBatch )
+        if size != self.batchSize:
+            log.debug( f'Adaptive batch size changed from {self.batchSize} to {size}.' )
+            self.batchSize = size
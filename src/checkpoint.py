@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Keeps track of how far the measurements of each bus have been successfully sent to FIWARE.
+Collecting can then be resumed from where it was left after a restart.
+Checkpoints are saved to a SQLite database in the state directory. Each save is done in one transaction
+so a checkpoint is either completely saved or not at all even if the tool is stopped in the middle of it.
+The database can be used by multiple processes at the same time.
+'''
+
+import sqlite3
+import logging
+
+import utils
+
+# logger for module
+log = logging.getLogger( __name__ )
+
+# directory for files the tool uses to keep its state between runs
+stateDir = utils.getAppDir() / 'state'
+# the checkpoint database file
+checkpointFile = stateDir / 'checkpoints.db'
+
+def load( collection ):
+    '''
+    Get the checkpoints of the given collection.
+    Collection is a string identifying the collection operation e.g. the collected time period.
+    Returns a dictionary with site id as key and the end of the last period sent to FIWARE as value.
+    The end is a unix timestamp in microseconds.
+    '''
+    connection = _connect()
+    try:
+        rows = connection.execute( 'SELECT site, sentUntil FROM checkpoints WHERE collection = ?', ( collection, )).fetchall()
+
+    finally:
+        connection.close()
+
+    return dict( rows )
+
+def save( collection, sites, end ):
+    '''
+    Save a checkpoint for the given sites of the collection.
+    End is the end of the period whose measurements have been sent to FIWARE for the sites.
+    '''
+    connection = _connect()
+    try:
+        # the connection as a context manager commits the transaction or rolls it back if there is an error
+        with connection:
+            connection.executemany( 'INSERT OR REPLACE INTO checkpoints ( collection, site, sentUntil ) VALUES ( ?, ?, ? )',
+                                    [ ( collection, site, end ) for site in sites ] )
+
+    finally:
+        connection.close()
+
+def _connect():
+    '''
+    Internal method for opening a connection to the checkpoint database.
+    Creates the database if it does not exist yet.
+    '''
+    stateDir.mkdir( exist_ok = True )
+    # other processes may be saving their checkpoints at the same time so wait for them if needed
+    connection = sqlite3.connect( str( checkpointFile ), timeout = 60 )
+    connection.execute( 'CREATE TABLE IF NOT EXISTS checkpoints ( collection TEXT, site TEXT, sentUntil INTEGER, PRIMARY KEY ( collection, site ))' )
+    return connection
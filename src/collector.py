@@ -12,12 +12,27 @@ entities and sending them to FIWARE.
 import fiware
 import dataConverter
 import iotTicket
+import config
+import checkpoint
+import archive
+import utils
+import metrics
+import tracing
+from spool import Spool
+from series import Series
 from utils import s2mrs, mrs2s
 
 import time
 import random
+import re
+import asyncio
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
 from datetime import datetime
 import logging
+import logging.handlers
 
 # if collecting historical data how much data to get from IoT-Ticket in one request
 # i.e. the length of time between begin and end times given to iotTicket.getData method.  
@@ -52,10 +67,53 @@ class Collector():
             self.stop = endDate.timestamp()
             self.stop = s2mrs( round( self.stop ) ) -500001
             
+        # checkpoints of this collection are saved with this key
+        self.checkpointKey = _getCheckpointKey( startDate, endDate )
+        # spool updates are written to if spooling is used
+        self.spool = None
+        # sites whose measurements are collected
+        self.siteIds = list( dataConverter.busNames.keys() )
+            
     def startCollecting(self):
         '''
         Begin the defined collecting operation.
         '''
+        self._openSpool()
+        try:
+            self._initPeriod()
+            # set the end to correct value
+            self._setEndAndWait()
+            while self.getData:
+                # log current state including begin and end
+                self._printState()
+                with tracing.cycle( begin = self.begin, end = self.end ):
+                    # get data from IoT-Ticket for current period i.e. between begin and end
+                    data = self._getData( self.begin, self.end )
+                    #self._fakeGetMeasurements()
+                    
+                    #iotTicket.printDataStats( data )
+                    # convert to FIWARE entity updates
+                    updates = self._convertData( self.begin, self.end, data )
+                    # and send to FIWARE
+                    self._sendUpdates( self.begin, self.end, updates )
+                    
+                #time.sleep( 20 )
+                #fiware.checkUpdates( updates )
+                # set begin to end +1 microseconds
+                self.begin = self.end +1
+                # calcualte appropriate end for next measurements
+                self._setEndAndWait()
+                
+            self._closeSpool()
+            
+        except KeyboardInterrupt:
+            self._stopSpool()
+            raise
+            
+    def _initPeriod(self):
+        '''
+        Sets the begin and period for the first measurement collection.
+        '''
         # self.begin and self.end are used to define the next data collection start and end
         # they are unix timestamps in microseconds
         # self.period determines length of the next measurement collection period
@@ -80,37 +138,145 @@ class Collector():
         # so we first round begin to seconds then subtract half a second and them convert to microseconds
         # we will then get everything that rounds to begin rounded    
         self.begin = s2mrs( round( self.begin ) ) -s2mrs( 0.5 )
-        # set the end to correct value
-        self._setEndAndWait()
-        while self.getData:
-            # log current state including begin and end
-            self._printState()
-            # get data from IoT-Ticket for current period i.e. between begin and end
-            data = iotTicket.getData( self.begin, self.end )
-            #self._fakeGetMeasurements()
-            
-            #iotTicket.printDataStats( data )
-            # convert to FIWARE entity updates
-            updates = dataConverter.convertToEntityUpdates( data )
-            #dataConverter.saveUpdatesToFile( updates )
-            #updates = dataConverter.loadUpdates()
-            # and send to FIWARE
-            fiware.sendData( updates )
-            #time.sleep( 20 )
-            #fiware.checkUpdates( updates )
-            # set begin to end +1 microseconds
-            self.begin = self.end +1
-            # calcualte appropriate end for next measurements
-            self._setEndAndWait()
+        if useCheckpoints:
+            self._resumeFromCheckpoint()
+            
+    def _resumeFromCheckpoint(self):
+        '''
+        If measurements after the current begin have already been sent to FIWARE in an earlier run
+        set begin to right after them.
+        In real time collection begin is always set to the checkpoint so that the measurements of the time
+        the tool was not running are collected too.
+        '''
+        checkpoints = checkpoint.load( self.checkpointKey )
+        if len( checkpoints ) == 0 or not set( self.siteIds ).issubset( checkpoints.keys() ):
+            # no checkpoint for some bus so everything has to be collected
+            return
+        
+        # continue from the bus which is furthest behind
+        resumeBegin = min( checkpoints[ siteId ] for siteId in self.siteIds ) +1
+        if resumeBegin > self.begin or self.startDate == None:
+            log.info( f'Resuming collection from checkpoint {datetime.fromtimestamp( mrs2s( resumeBegin ))}.' )
+            self.begin = resumeBegin
+            
+    def _getData(self, begin, end ):
+        '''
+        Get measurements between begin and end from IoT-Ticket.
+        If FIWARE is unavailable waits until it is available again before getting more measurements
+        unless updates are spooled in which case collecting continues and the updates are sent later.
+        '''
+        if self.spool == None and not fiware.waitUntilAvailable():
+            # collecting was interrupted while waiting
+            raise KeyboardInterrupt()
+        
+        with tracing.span( 'fetch', begin = begin, end = end ):
+            data = iotTicket.getData( begin, end, self._getHorizon(), self.siteIds )
+            
+        self._record( begin, end, data )
+        return data
+    
+    def _getHorizon(self):
+        '''
+        Get the latest time measurements can be fetched for ahead of the current period.
+        It is the stop time or the time we expect IoT-Ticket to have measurements for if that is earlier.
+        '''
+        if self.stop != None:
+            return min( self.stop, self._getLastTime() )
+        
+        return self._getLastTime()
+    
+    def _record(self, begin, end, data ):
+        '''
+        Save the measurements fetched for the period between begin and end to the archive if recording is on.
+        '''
+        if recordArchive:
+            with tracing.span( 'record', begin = begin, end = end ):
+                archive.save( archiveDir, begin, end, data, self._getArchiveKey() )
+                
+    def _getArchiveKey(self):
+        '''
+        Get the key added to the names of the archive files of this collection or None if the files contain all buses.
+        '''
+        return None
+            
+    def _convertData(self, begin, end, data ):
+        '''
+        Convert the measurements of the period between begin and end to entity updates.
+        '''
+        with tracing.span( 'convert', begin = begin, end = end ):
+            return dataConverter.convertToEntityUpdates( data )
+            
+    def _sendUpdates(self, begin, end, updates ):
+        '''
+        Send updates for the period between begin and end to FIWARE and save a checkpoint after they have been sent.
+        If spooling is used the updates are only written to the spool and the checkpoint is saved after that.
+        '''
+        with tracing.span( 'send', begin = begin, end = end ):
+            if self.spool != None:
+                # the spool's drainer sends them
+                self.spool.append( end, updates )
+                
+            else:
+                fiware.sendData( updates )
+            
+        if useCheckpoints:
+            checkpoint.save( self.checkpointKey, updates.keys(), end )
+            
+        for siteId in updates.keys():
+            metrics.collectedUntil.set( mrs2s( end ), bus = dataConverter.getBusName( siteId ))
+            
+    def _openSpool(self):
+        '''
+        Open the spool of this collection and start sending updates from it if spooling is used.
+        Updates left in the spool by an earlier run of the same collection are sent first.
+        '''
+        if useSpool:
+            # each collection has its own spool so that for example backfill shards do not share one
+            directory = spoolDir / re.sub( r'[^0-9A-Za-z]', '_', self._getSpoolKey() )
+            self.spool = Spool( directory, fiware.sendData, segmentBytes = round( spoolSegmentMb *2**20 ), drainBatch = spoolDrainBatch )
+            self.spool.start()
+            
+    def _getSpoolKey(self):
+        '''
+        Get the key the spool directory of this collection is named after.
+        '''
+        return self.checkpointKey
+    
+    def _closeSpool(self):
+        '''
+        Wait until everything in the spool has been sent.
+        '''
+        if self.spool != None:
+            log.debug( 'Waiting for spooled updates to be sent.' )
+            self.spool.finish()
+            
+    def _stopSpool(self):
+        '''
+        Stop sending from the spool when collecting is interrupted.
+        '''
+        if self.spool != None:
+            self.spool.stop()
+            # interrupt the update the drainer may be sending
+            fiware.stop()
             
     def _setEndAndWait(self):
         '''
         Calculates the correct end for next measurements.
-        It will be based on current begin, period used (real time or history) and current time.
         If required waits (sleeps) so we do not get measurements too early.
         '''
+        sleepTime = self._setEnd()
+        if sleepTime > 0:
+            time.sleep( sleepTime )
+            
+    def _setEnd(self):
+        '''
+        Calculates the correct end for next measurements.
+        It will be based on current begin, period used (real time or history) and current time.
+        Returns how many seconds we have to wait so we do not get measurements too early. 0 if there is no need to wait.
+        '''
         # first assume we can just get for the full period we are using now
         self.end = self.begin +self.period -1
+        sleepTime = 0
         
         # if we have stop time check if we are over it i.e. we can stop collecting
         if self.stop != None and self.begin >= self.stop:
@@ -145,7 +311,6 @@ class Collector():
                 # we should wait until the current end is at least wait seconds before current time
                 sleepTime = mrs2s(self.end +wait -s2mrs( time.time() )) 
                 log.debug( f'{sleepTime:.1f} seconds before getting next measurements.' )
-                time.sleep( sleepTime )
         
         # check when using the real time collecting period are we behind the current moment meaning we should catch up
         # by getting measurements for a longer period        
@@ -162,6 +327,15 @@ class Collector():
                 # we are behind more than the history period so lets switch to use it for now until we catch up
                 self.period = historyPeriod
                 self.end = self.begin +self.period -1
+                
+        self._reportPeriod()
+        return sleepTime
+    
+    def _reportPeriod(self):
+        '''
+        Update the current period to the metrics.
+        '''
+        metrics.period.set( mrs2s( self.period ))
         
     def _getLastTime(self):
         '''
@@ -189,4 +363,636 @@ class Collector():
         log.debug( f'{mrs2s(self.end -self.begin):.1f} measurement period.' )
         sleepTime = 40 *random.random()
         log.debug( f'{sleepTime:.1f} seconds for operation.' )
-        time.sleep( sleepTime )
\ No newline at end of file
+        time.sleep( sleepTime )
+        
+class AsyncCollector( Collector ):
+    '''
+    Collector that uses asyncio for the collecting process.
+    Measurement collection periods are determined the same way as in the Collector.
+    Measurements of the datanodes are fetched concurrently and while updates from one period are
+    being sent to FIWARE the measurements for the next period are already fetched from IoT-Ticket.
+    '''
+    
+    def startCollecting(self):
+        '''
+        Begin the defined collecting operation.
+        '''
+        self._openSpool()
+        try:
+            asyncio.run( self._collect() )
+            self._closeSpool()
+            
+        except KeyboardInterrupt:
+            # make sure that requests being retried in other threads are not retried anymore
+            self._stopSpool()
+            iotTicket.stop()
+            fiware.stop()
+            raise
+        
+    async def _collect(self):
+        '''
+        Coroutine that does the actual collecting.
+        '''
+        loop = asyncio.get_running_loop()
+        # updates are sent in a separate thread one period at a time so that they arrive to FIWARE in order
+        sendExecutor = ThreadPoolExecutor( max_workers = 1, thread_name_prefix = 'fiware' )
+        # sending of the previous period's updates or None if nothing is being sent
+        sending = None
+        self._initPeriod()
+        await self._setEndAndWaitAsync()
+        while self.getData:
+            self._printState()
+            if self.spool == None and not await loop.run_in_executor( None, fiware.waitUntilAvailable ):
+                raise KeyboardInterrupt()
+                
+            with tracing.cycle( begin = self.begin, end = self.end ):
+                with tracing.span( 'fetch', begin = self.begin, end = self.end ):
+                    data = await iotTicket.getDataAsync( self.begin, self.end, self._getHorizon() )
+                    
+                self._record( self.begin, self.end, data )
+                updates = self._convertData( self.begin, self.end, data )
+                # previous updates have to be sent before sending these
+                if sending != None:
+                    await sending
+                    
+                sending = loop.run_in_executor( sendExecutor, self._sendUpdates, self.begin, self.end, updates )
+                
+            self.begin = self.end +1
+            # updates are sent while we wait for the next period
+            await self._setEndAndWaitAsync()
+            
+        if sending != None:
+            await sending
+            
+        sendExecutor.shutdown()
+            
+    async def _setEndAndWaitAsync(self):
+        '''
+        Same as _setEndAndWait but waits without blocking the event loop.
+        '''
+        sleepTime = self._setEnd()
+        if sleepTime > 0:
+            await asyncio.sleep( sleepTime )
+            
+class PipelineCollector( Collector ):
+    '''
+    Collector where fetching, converting and sending measurements are separate stages running in their own threads.
+    The stages are connected with bounded queues so that a stage can work on one period while the next stage
+    works on the previous one. When a queue is full the previous stage waits until there is room in it.
+    Each stage handles the periods one at a time in order so the updates are sent to FIWARE in the order of the periods.
+    Measurement collection periods are determined the same way as in the Collector.
+    '''
+    
+    def startCollecting(self):
+        '''
+        Begin the defined collecting operation.
+        '''
+        # set if a stage fails or collecting is interrupted so that the other stages know to stop
+        self._stopping = threading.Event()
+        # the exception of the stage that failed
+        self._stageError = None
+        # queues between the stages: periods to fetch, fetched measurements and converted updates
+        periods = queue.Queue( maxsize = pipelineQueueSize )
+        measurements = queue.Queue( maxsize = pipelineQueueSize )
+        updates = queue.Queue( maxsize = pipelineQueueSize )
+        stages = [
+            threading.Thread( target = self._runStage, args = ( 'fetch', self._fetch, periods, measurements ), name = 'fetch', daemon = True ),
+            threading.Thread( target = self._runStage, args = ( 'convert', self._convert, measurements, updates ), name = 'convert', daemon = True ),
+            threading.Thread( target = self._runStage, args = ( 'send', self._send, updates, None ), name = 'send', daemon = True )
+        ]
+        
+        self._openSpool()
+        for stage in stages:
+            stage.start()
+            
+        try:
+            try:
+                # this thread produces the periods for the fetch stage
+                self._producePeriods( periods )
+                # tell the stages that there are no more periods
+                self._put( periods, None )
+                
+            except _PipelineStopped:
+                # a stage failed so there is no need for more periods
+                pass
+            
+            # wait for the stages to finish
+            for stage in stages:
+                while stage.is_alive():
+                    if self._stopping.is_set():
+                        # a stage failed so the others should not keep retrying failed requests
+                        iotTicket.stop()
+                        fiware.stop()
+                        
+                    stage.join( 1 )
+                
+            if self._stopping.is_set():
+                self._stopSpool()
+                iotTicket.stop()
+                fiware.stop()
+                raise RuntimeError( 'Collecting stopped because a pipeline stage failed.' ) from self._stageError
+            
+            self._closeSpool()
+                
+        except KeyboardInterrupt:
+            self._stopping.set()
+            self._stopSpool()
+            iotTicket.stop()
+            fiware.stop()
+            raise
+        
+    def _producePeriods(self, periods ):
+        '''
+        Put the begin and end of each period to be collected to the periods queue.
+        '''
+        self._initPeriod()
+        self._setEndAndWait()
+        while self.getData:
+            self._printState()
+            self._put( periods, ( self.begin, self.end ))
+            self.begin = self.end +1
+            self._setEndAndWait()
+            
+    def _setEndAndWait(self):
+        '''
+        Same as in Collector but the waiting ends if a stage fails or collecting is interrupted.
+        '''
+        sleepTime = self._setEnd()
+        if sleepTime > 0 and self._stopping.wait( sleepTime ):
+            raise _PipelineStopped()
+        
+    def _runStage(self, name, operation, inQueue, outQueue ):
+        '''
+        Runs a pipeline stage.
+        Takes items from inQueue, processes them with operation and puts the results to outQueue if there is one.
+        Stops when it gets None from inQueue. None is passed on to the next stage.
+        '''
+        try:
+            while True:
+                item = self._get( inQueue )
+                if item == None:
+                    break
+                
+                result = operation( *item )
+                if outQueue != None:
+                    self._put( outQueue, result )
+                    
+        except ( _PipelineStopped, KeyboardInterrupt ):
+            # collecting was stopped elsewhere
+            return
+        
+        except Exception as error:
+            log.exception( f'Pipeline {name} stage failed.' )
+            self._stageError = error
+            self._stopping.set()
+            return
+            
+        if outQueue != None:
+            self._put( outQueue, None )
+            
+    def _fetch(self, begin, end ):
+        '''
+        Fetch stage operation: get the measurements for a period.
+        '''
+        return begin, end, self._getData( begin, end )
+    
+    def _convert(self, begin, end, data ):
+        '''
+        Convert stage operation: convert the measurements to entity updates.
+        '''
+        return begin, end, self._convertData( begin, end, data )
+    
+    def _send(self, begin, end, updates ):
+        '''
+        Send stage operation: send the updates to FIWARE.
+        '''
+        self._sendUpdates( begin, end, updates )
+        
+    def _put(self, toQueue, item ):
+        '''
+        Put an item to a queue waiting for room in it.
+        Raises _PipelineStopped if pipeline is stopped while waiting.
+        '''
+        while True:
+            if self._stopping.is_set():
+                raise _PipelineStopped()
+            
+            try:
+                toQueue.put( item, timeout = 1 )
+                return
+            
+            except queue.Full:
+                pass
+            
+    def _get(self, fromQueue ):
+        '''
+        Get an item from a queue waiting for it to be available.
+        Raises _PipelineStopped if pipeline is stopped while waiting.
+        '''
+        while True:
+            if self._stopping.is_set():
+                raise _PipelineStopped()
+            
+            try:
+                return fromQueue.get( timeout = 1 )
+            
+            except queue.Empty:
+                pass
+            
+class _PipelineStopped( Exception ):
+    '''
+    Raised inside PipelineCollector when the pipeline is stopped.
+    '''
+    pass
+            
+class ReplayCollector( PipelineCollector ):
+    '''
+    Collector that replays measurements saved to the archive instead of fetching them from IoT-Ticket.
+    The archived periods between the start and end dates, or all of them if there are no dates, are loaded, converted and
+    sent to FIWARE as fast as possible with the pipeline stages. Can be used to send the data to a new FIWARE instance
+    without loading IoT-Ticket or to load test FIWARE.
+    '''
+    
+    def __init__(self, startDate, endDate ):
+        super().__init__( startDate, endDate )
+        # keep replay checkpoints separate from those of the collection that recorded the archive
+        self.checkpointKey = 'replay:' +self.checkpointKey
+        
+    def _producePeriods(self, periods ):
+        '''
+        Put the archived periods that overlap the time between start and end dates to the periods queue.
+        '''
+        self.begin = 0
+        if self.startDate != None:
+            self.begin = s2mrs( round( self.startDate.timestamp() ) ) -s2mrs( 0.5 )
+        
+        if useCheckpoints:
+            self._resumeFromCheckpoint()
+            
+        windows = [ ( begin, end ) for begin, end in archive.listWindows( archiveDir ) if end >= self.begin and ( self.stop == None or begin <= self.stop ) ]
+        log.info( f'Replaying {len( windows )} archived periods from {archiveDir}.' )
+        for window in windows:
+            self._put( periods, window )
+            
+    def _fetch(self, begin, end ):
+        '''
+        Fetch stage operation: load the measurements of a period from the archive.
+        '''
+        with tracing.span( 'load', begin = begin, end = end ):
+            return begin, end, archive.load( archiveDir, begin, end )
+            
+class PerBusCollector( Collector ):
+    '''
+    Collector where each bus has its own cursor i.e. its own begin, end and period.
+    The buses are collected concurrently each in its own thread the same way as the Collector collects all of them.
+    A slow or failing bus does not hold back the others and a bus that is behind catches up with the longer history period
+    while the others stay in real time. The IoT-Ticket worker pool limits how many requests are done at once
+    and at most max_concurrent_requests from the FIWARE configuration buses send updates at the same time.
+    A bus whose collection fails unexpectedly is restarted from where it was after a delay.
+    '''
+    
+    def startCollecting(self):
+        '''
+        Begin the defined collecting operation.
+        '''
+        # set when collecting is interrupted so that the buses know to stop
+        self._stopping = threading.Event()
+        sendSlots = threading.BoundedSemaphore( fiware.maxRequests )
+        cursors = [ _BusCursor( self.startDate, self.endDate, siteId, self._stopping, sendSlots ) for siteId in self.siteIds ]
+        threads = [ threading.Thread( target = self._runCursor, args = ( cursor, ), name = cursor.busName, daemon = True ) for cursor in cursors ]
+        for thread in threads:
+            thread.start()
+            
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join( 1 )
+                    
+        except KeyboardInterrupt:
+            self._stopping.set()
+            for cursor in cursors:
+                if cursor.spool != None:
+                    cursor.spool.stop()
+                    
+            iotTicket.stop()
+            fiware.stop()
+            raise
+        
+    def _runCursor(self, cursor ):
+        '''
+        Collect the measurements of one bus until done or interrupted.
+        '''
+        while not self._stopping.is_set():
+            try:
+                cursor.startCollecting()
+                return
+            
+            except KeyboardInterrupt:
+                # collecting was stopped
+                return
+            
+            except:
+                log.exception( f'Collecting {cursor.busName} failed. Restarting it after {busRestartDelay} seconds.' )
+                self._stopping.wait( busRestartDelay )
+                
+class _BusCursor( Collector ):
+    '''
+    Internal class that collects the measurements of one bus for the PerBusCollector.
+    Works like the Collector but only for one site and it can be stopped from another thread while it waits.
+    '''
+    
+    def __init__(self, startDate, endDate, siteId, stopping, sendSlots ):
+        '''
+        Create cursor for the given site. Stopping is a threading.Event set when collecting is stopped
+        and sendSlots is a semaphore that limits how many cursors send updates at the same time.
+        '''
+        super().__init__( startDate, endDate )
+        self.siteIds = [ siteId ]
+        self.busName = dataConverter.getBusName( siteId )
+        self.stopping = stopping
+        self.sendSlots = sendSlots
+        # set when the first period is initialized
+        self.begin = None
+        
+    def _initPeriod(self):
+        '''
+        Sets the begin and period for the first measurement collection.
+        If the cursor is restarted after a failure collecting continues from the period that failed.
+        '''
+        if self.begin == None:
+            super()._initPeriod()
+            
+        else:
+            self.getData = True
+            
+    def _openSpool(self):
+        '''
+        Open the spool unless it was already opened before the cursor was restarted.
+        '''
+        if self.spool == None:
+            super()._openSpool()
+            
+    def _getSpoolKey(self):
+        # each bus has its own spool
+        return f'{self.checkpointKey}/{self.busName}'
+    
+    def _getArchiveKey(self):
+        # each bus is collected separately so each bus has its own files
+        return self.siteIds[0]
+    
+    def _sendUpdates(self, begin, end, updates ):
+        with self.sendSlots:
+            super()._sendUpdates( begin, end, updates )
+            
+    def _setEndAndWait(self):
+        '''
+        Same as in Collector but the waiting ends if collecting is stopped.
+        '''
+        sleepTime = self._setEnd()
+        if sleepTime > 0 and self.stopping.wait( sleepTime ):
+            raise KeyboardInterrupt()
+        
+    def _reportPeriod(self):
+        metrics.busPeriod.set( mrs2s( self.period ), bus = self.busName )
+        
+    def _printState(self):
+        log.debug( f'Getting next measurements of {self.busName}. begin: {datetime.fromtimestamp(mrs2s(self.begin))}, end: {datetime.fromtimestamp(mrs2s(self.end))}, period: {mrs2s(self.period)}' )
+        
+class LatestCollector( Collector ):
+    '''
+    Real time collector that polls the latest measurement of each datanode with one request per bus instead of
+    requesting the measurements of each datanode for a period. New measurements are sent to FIWARE within seconds.
+    Only the latest measurement at each poll is seen so datanodes updated more often than the poll interval lose measurements.
+    Historical periods cannot be collected this way so if dates are given collecting is done as with the Collector.
+    '''
+    
+    def __init__(self, startDate, endDate ):
+        super().__init__( startDate, endDate )
+        # polling does not collect everything so its checkpoints are kept separate from those of normal real time collection
+        self.checkpointKey = 'latest'
+        # timestamp of the latest measurement seen for each site id and datanode name pair
+        self.lastTimestamps = {}
+        
+    def startCollecting(self):
+        '''
+        Begin the defined collecting operation.
+        '''
+        if self.startDate != None or self.endDate != None:
+            log.info( 'Only real time collection can be done with the latest measurements. Collecting the given period with the sequential collector.' )
+            self.checkpointKey = _getCheckpointKey( self.startDate, self.endDate )
+            super().startCollecting()
+            return
+        
+        self._openSpool()
+        try:
+            metrics.period.set( latestPollInterval )
+            # begin and end tell when the previous and current polls were done
+            self.begin = s2mrs( time.time() )
+            while True:
+                pollStart = time.time()
+                if self.spool == None and not fiware.waitUntilAvailable():
+                    raise KeyboardInterrupt()
+                
+                self.end = s2mrs( pollStart )
+                with tracing.cycle( begin = self.begin, end = self.end ):
+                    with tracing.span( 'fetch', begin = self.begin, end = self.end ):
+                        data = self._getNewData()
+                    
+                    updates = self._convertData( self.begin, self.end, data )
+                    self._sendUpdates( self.begin, self.end, updates )
+                    
+                self.begin = self.end +1
+                sleepTime = latestPollInterval -( time.time() -pollStart )
+                if sleepTime > 0:
+                    time.sleep( sleepTime )
+                    
+        except KeyboardInterrupt:
+            self._stopSpool()
+            raise
+        
+    def _getNewData(self):
+        '''
+        Get the latest measurements which have not been seen in earlier polls.
+        Returns a dictionary in the same format as iotTicket.getData.
+        '''
+        data = {}
+        for siteId, siteData in iotTicket.getLatestData().items():
+            newData = {}
+            data[ siteId ] = newData
+            for name, series in siteData.items():
+                key = ( siteId, name )
+                if len( series ) == 0 or self.lastTimestamps.get( key ) == series.timestamps[0]:
+                    newData[ name ] = Series()
+                    
+                else:
+                    self.lastTimestamps[ key ] = series.timestamps[0]
+                    newData[ name ] = series
+                    
+            # latitude and longitude are updated separately and a location is created only if their timestamps match
+            # so when either of them is new both are used even if the other one has been seen before
+            if len( newData['Latitude'] ) > 0 or len( newData['Longitude'] ) > 0:
+                newData['Latitude'] = siteData['Latitude']
+                newData['Longitude'] = siteData['Longitude']
+                
+        return data
+            
+class BackfillCollector( Collector ):
+    '''
+    Collector that splits the historical collection period into shards which are collected in parallel by worker processes.
+    Each shard is collected by its own Collector that fetches, converts and sends the measurements of the shard.
+    Shards start and end on whole seconds so that the periods collected by shards neither overlap nor leave gaps between them.
+    If there is no end date real time collection is started after all shards have been collected.
+    '''
+    
+    def startCollecting(self):
+        '''
+        Begin the defined collecting operation.
+        '''
+        if self.startDate == None:
+            # nothing to backfill just collect in real time
+            super().startCollecting()
+            return
+        
+        if self.endDate != None:
+            rangeEnd = self.endDate
+            
+        else:
+            # collect shards up to the last whole second we expect IoT-Ticket to have measurements for
+            # and continue from there in real time
+            rangeEnd = datetime.fromtimestamp( int( mrs2s( self._getLastTime() )))
+            
+        shards = self._getShards( self.startDate, rangeEnd )
+        if len( shards ) > 0:
+            self._collectShards( shards )
+            
+        if self.endDate == None:
+            # rest is collected with the normal collection process
+            self.startDate = rangeEnd
+            super().startCollecting()
+        
+    def _getShards(self, startDate, endDate ):
+        '''
+        Split the time between start and end dates to shards.
+        Returns a list of start and end datetime tuples.
+        Shard boundaries are rounded to whole seconds the same way the Collector rounds its start and end dates.
+        Each shard ends where the next one starts so that the Collector of a shard stops just before the
+        begin the next shard's Collector uses.
+        '''
+        first = round( startDate.timestamp() )
+        last = round( endDate.timestamp() )
+        shardLength = round( backfillShardHours *3600 )
+        shards = []
+        for shardStart in range( first, last, shardLength ):
+            shardEnd = min( shardStart +shardLength, last )
+            shards.append(( datetime.fromtimestamp( shardStart ), datetime.fromtimestamp( shardEnd )))
+            
+        return shards
+        
+    def _collectShards(self, shards ):
+        '''
+        Collect the given shards with a pool of worker processes.
+        Returns when all shards have been collected.
+        '''
+        log.info( f'Collecting {len( shards )} shards from {shards[0][0]} to {shards[-1][1]} with {backfillWorkers} processes.' )
+        # worker processes are started from scratch instead of forking this process
+        # so that they do not share this process' open connections and threads
+        context = multiprocessing.get_context( 'spawn' )
+        # log messages from workers are sent to this process and handled by its log handlers
+        logQueue = context.Queue()
+        logListener = logging.handlers.QueueListener( logQueue, *logging.getLogger().handlers, respect_handler_level = True )
+        logListener.start()
+        pool = ProcessPoolExecutor( max_workers = backfillWorkers, mp_context = context,
+                                    initializer = _initShardWorker, initargs = ( logQueue, iotTicket.dataNodes ))
+        try:
+            futures = { pool.submit( _collectShard, shardStart, shardEnd ): ( shardStart, shardEnd ) for shardStart, shardEnd in shards }
+            for future in as_completed( futures ):
+                # raises the exception if collecting the shard failed
+                future.result()
+                log.info( 'Shard from {0} to {1} collected.'.format( *futures[ future ] ))
+                
+        except KeyboardInterrupt:
+            # workers get the interrupt too so just do not wait for them
+            pool.shutdown( wait = False )
+            raise
+        
+        finally:
+            logListener.stop()
+        
+        pool.shutdown()
+        log.info( 'All shards collected.' )
+        
+def _getCheckpointKey( startDate, endDate ):
+    '''
+    Get the key used for checkpoints of a collection between the start and end dates.
+    '''
+    if startDate == None:
+        return 'realtime'
+    
+    if endDate == None:
+        return startDate.isoformat()
+    
+    return f'{startDate.isoformat()}/{endDate.isoformat()}'
+        
+def _initShardWorker( logQueue, nodes ):
+    '''
+    Initializes a backfill worker process.
+    Sends log messages to the main process through logQueue and sets the datanodes measurements are fetched from.
+    '''
+    rootLog = logging.getLogger()
+    rootLog.setLevel( logging.DEBUG )
+    rootLog.addHandler( logging.handlers.QueueHandler( logQueue ))
+    # same as in the main process urllib3 would log every request with the root logger's level
+    logging.getLogger( 'urllib3' ).setLevel( logging.WARNING )
+    iotTicket.dataNodes.update( nodes )
+    
+def _collectShard( startDate, endDate ):
+    '''
+    Collects measurements of one backfill shard in a worker process.
+    '''
+    Collector( startDate, endDate ).startCollecting()
+            
+# read collector configuration
+conf = config.loadConfig( 'collector.json' )
+collectorMode = conf.get( 'mode', 'sequential' )
+# how many periods can wait in each queue between the pipeline collector's stages
+pipelineQueueSize = conf.get( 'pipeline_queue_size', 2 )
+# number of worker processes and length of shards in hours for the backfill collector
+backfillWorkers = conf.get( 'backfill_workers', 4 )
+backfillShardHours = conf.get( 'backfill_shard_hours', 24 )
+# should collecting be resumed from where it was left last time
+useCheckpoints = conf.get( 'use_checkpoints', True )
+# should updates be written to a spool on disk and sent to FIWARE from there
+useSpool = conf.get( 'use_spool', False )
+# size in megabytes after which a new spool segment file is started
+spoolSegmentMb = conf.get( 'spool_segment_mb', 64 )
+# how many spooled periods can be sent together
+spoolDrainBatch = conf.get( 'spool_drain_batch', 10 )
+# directory under which the spools are kept
+spoolDir = checkpoint.stateDir / 'spool'
+# should the measurements fetched from IoT-Ticket be saved to the archive for replaying them later
+recordArchive = conf.get( 'record_archive', False )
+# directory of the measurement archive relative to the tool's root directory
+archiveDir = utils.getAppDir() / conf.get( 'archive_dir', 'state/archive' )
+# seconds to wait before restarting the collection of a bus that failed in the perbus mode
+busRestartDelay = conf.get( 'bus_restart_delay', 60 )
+# seconds between polls in the latest mode
+latestPollInterval = conf.get( 'latest_poll_interval', 5 )
+# port for serving metrics over HTTP. Metrics are not served if not given
+metricsPort = conf.get( 'metrics_port' )
+# address the metrics server listens on. Only local connections by default
+metricsHost = conf.get( 'metrics_host', '127.0.0.1' )
+# different ways of doing the collection and their corresponding collector classes
+collectorClasses = {
+    'sequential': Collector,
+    'async': AsyncCollector,
+    'pipeline': PipelineCollector,
+    'backfill': BackfillCollector,
+    'replay': ReplayCollector,
+    'perbus': PerBusCollector,
+    'latest': LatestCollector
+}
+
+collectorClass = collectorClasses.get( collectorMode )
+if collectorClass == None:
+    log.error( f'Invalid collector mode {collectorMode}. Available modes {", ".join( collectorClasses.keys())}.' )
+    exit()
\ No newline at end of file
@@ -8,6 +8,8 @@ Helper module for reading configuration files in the JSON format
 '''
 
 import json
+import os
+from pathlib import Path
 import utils
 
 def loadConfig( fileName ):
@@ -15,6 +17,17 @@ def loadConfig( fileName ):
     Reads the named file from configuration directory and converts it to JSON.
     The conversion result is returned.
     '''
-    confFile = utils.getAppDir() / 'conf' / fileName
+    confFile = getConfDir() / fileName
     with open( confFile, 'r' ) as file:
-        return json.load( file )
\ No newline at end of file
+        return json.load( file )
+        
+def getConfDir():
+    '''
+    Get the configuration directory.
+    It is the conf directory in the tool's root directory unless another directory is given in the COLLECTOR_CONF_DIR environment variable.
+    '''
+    confDir = os.environ.get( 'COLLECTOR_CONF_DIR' )
+    if confDir != None:
+        return Path( confDir )
+    
+    return utils.getAppDir() / 'conf'
\ No newline at end of file
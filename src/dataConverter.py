@@ -9,9 +9,15 @@ Contains the conversion information and mapping for IoT-Ticket site ids to bus n
 '''
 
 from datetime import datetime
-import json
+from itertools import repeat
+from functools import lru_cache
+import heapq
 import logging
 
+from series import Series
+import metrics
+import tracing
+
 # logger for module
 log = logging.getLogger( __name__ )
 
@@ -42,171 +48,220 @@ def _roundTimeStamps( data ):
     Data is the return value of iotTicket.getData.
     '''
     # go through all measurements
+    # we don't want duplicate timestamps i.e. measurements from the same datanode that after rounding have the same timestamp
+    # the series drops those
     for siteData in data.values():
-        for processdata in siteData.values():
-            # we don't want duplicate timestamps i.e. measurements from the same datanode that after rounding have the same timestamp
-            # we process the times from last to first and drop those that would have the same timestamp
-            prevTs = None # timestamp of the previously processed measurement
-            for i in range( len(processdata) -1, -1, -1):
-                measurement = processdata[i]
-                # convert to seconds and round
-                measurement['ts'] = round( measurement['ts'] /1000000 )
-                if prevTs != None and prevTs == measurement['ts']:
-                    del processdata[i +1]
-                    
-                prevTs = measurement['ts']
+        for series in siteData.values():
+            series.roundTimestamps()
                     
 def convertToEntityUpdates( data ):
     '''
     Convert data returned by iotTicket.getData to FIWARE entity updates.
+    Data has a dictionary for each site id. It has the measurements of each datanode of the site as a Series.
     Return value is dictionary with site id as key and value is
     list of entity updates for corresponding bus.
     Each entity update has attribute updates for the same time.
     '''            
-    _roundTimeStamps( data )
-    # combine latitude and longitude datanode values to location attribute
-    for siteData in data.values():
-        location = [] # save locations here
-        siteData['location'] = location
-        
-        # lets go through longitude and latitude measurements starting from the first items
-        # we will create a location from them if they have the same timestamp
-        # if not we will discard the measurement with earlier timestamp and look at the nesxt one
-        # get the latitude and longitude measurements and use separate indexes to go through both lists
-        lon = { 'items': siteData['Longitude'], 'index': 0 }
-        lat = { 'items': siteData['Latitude'], 'index': 0 }
-        # delete lat and lon from original data since they are no longer needed
-        del siteData['Longitude']
-        del siteData['Latitude']
+    with tracing.span( 'round timestamps' ):
+        _roundTimeStamps( data )
         
-        # process until we have reached the end of one of the lists after which we cannot create more locations
-        while lat['index'] < len( lat['items'] ) and lon['index'] < len( lon['items'] ):
-            if lat['items'][ lat['index'] ]['ts'] == lon['items'][ lon['index'] ]['ts']:
-                # same timestamp create location value and move to next in both lists
-                location.append( { 'v': [ lon['items'][ lon['index'] ]['v'], lat['items'][ lat['index'] ]['v'] ], 'ts': lat['items'][ lat['index'] ]['ts'] })
-                lat['index'] += 1
-                lon['index'] += 1
-
-            # discard which ever measurement is earlier
-            elif lat['items'][ lat['index'] ]['ts'] < lon['items'][ lon['index'] ]['ts']:
-                lat['index'] += 1
-                
-            else:
-                lon['index'] += 1
-
-    # delete all datanodes for which we do not have values
-    for siteData in data.values():
-        names = set( siteData.keys() )
-        for nodeName in names:
-            if len( siteData[nodeName] ) == 0:
-                del siteData[ nodeName ]
-                
     updates = {} # entity updates are saved here        
     for siteName, siteData in data.items():
-        siteUpdates = [] # entity updates for a single bus
-        updates[ siteName ] = siteUpdates
-        # names of datanodes we currently have values which in the beginning is all of them
-        # during the process we will remove names of the datanodes whose values we have already processed
-        nodeNames = set( siteData.keys() )
-        # quantumleap requires that all attributes in a single update have the same timestamp
-        # datanodes are updated at different times and frequencies so we have to find the values which have the same timestamp
-        # so we will be processing values at different indexes at the value lists starting from the first ones 
-        indexes = {} # indexes for each datanode value lists
-        for name in nodeNames:
-            indexes[name] = 0
-        
-        # process until we have no values left i.e. we have gone through each datanode's values    
-        while len( nodeNames ) > 0:
-            entity = {} # entity update goes here
-            # collect names of nodes that no longer have values here
-            doneNodes = set()
-            # find the earliest timestamp we have at least one value for
-            ts = min( [ siteData[name][ indexes[name]]['ts'] for name in nodeNames ] )
-            # for each datanode values list at the index we are currently at see if
-            # the value is from the earliest time stamp
-            # if it is create an attribute update from it
-            for nodeName in nodeNames:
-                processdata = siteData[nodeName]
-                index = indexes[ nodeName ]
-                data = processdata[ index ]
-                if ts == data['ts']:
-                    # this value is now processed so for the next round we will check the next value
-                    indexes[ nodeName ] = index +1
-                    if index == len( processdata ) -1:
-                        # all values for the node has been processed so add to doneNodes
-                        doneNodes.add( nodeName )
+        # latitude and longitude are combined to location and other datanodes are used as is
+        nodes = { nodeName: series for nodeName, series in siteData.items() if nodeName not in [ 'Latitude', 'Longitude' ] }
+        with tracing.span( 'join location', bus = getBusName( siteName )):
+            nodes['location'] = _joinLocation( siteData['Latitude'], siteData['Longitude'] )
             
-                    attribute = {} # new attribute update goes here
-                    # get information used to convert the datanode to attribute
-                    conversionInfo = attributes[ nodeName ]
-                    if nodeName == 'location':
-                        # create a geo json item as the location value
-                        attribute['type'] = 'geo:json'
-                        attribute['value'] = {
-                            'type': 'Point',
-                            'coordinates': data['v']
-                        }
-                    
-                    else:
-                        # other attributes are processed similarly
-                        value = data['v']
-                        # see if there is a value mapping for this datanode
-                        if 'mapping' in conversionInfo:
-                            try:
-                                # change the value according to the mapping
-                                value = conversionInfo[ 'mapping' ][str(value)]
-                                
-                            except KeyError:
-                                log.warning( f'No conversion mapping for {nodeName} value {value} of {siteName} at {datetime.fromtimestamp( data["ts"] )}.' )
-                                # discard this value 
-                                continue
-                                
-                        attribute['value'] = value
-                        # if type is not in conversion info we assume a number
-                        attribute['type'] = conversionInfo.get( 'type', 'Number' )
-                        
-                    attribute['metadata'] = {
-                        'timestamp': {
-                            'type': 'DateTime',
-                            'value': datetime.utcfromtimestamp( data['ts'] ).isoformat() +'Z'
-                        }
-                    }
-
-                    # get attribute name from conversion info
-                    entity[ conversionInfo['name'] ] = attribute
-                    
-            # Remove nodes we don't any more have values from the nodes we are processing
-            nodeNames.difference_update( doneNodes )
+        # datanodes for which we do not have values are not needed
+        nodes = { nodeName: series for nodeName, series in nodes.items() if len( series ) > 0 }
+        with tracing.span( 'merge', bus = getBusName( siteName )):
+            updates[ siteName ] = _mergeToEntityUpdates( siteName, nodes )
             
-            entity['id'] = getBusId( siteName )
-            entity['type'] = 'Vehicle'
-            siteUpdates.append( entity )
+        metrics.measurementsConverted.inc( sum( len( series ) for series in nodes.values() ), bus = getBusName( siteName ))
             
     return updates
+
+def _joinLocation( lat, lon ):
+    '''
+    Internal method that combines latitude and longitude series to a location series.
+    A location is created when latitude and longitude have the same timestamp.
+    Its value is a list with longitude and latitude.
+    '''
+    latTs = lat.timestamps
+    lonTs = lon.timestamps
+    location = Series()
+    # lets go through longitude and latitude measurements starting from the first items
+    # we will create a location from them if they have the same timestamp
+    # if not we will discard the measurement with earlier timestamp and look at the nesxt one
+    # use separate indexes to go through both
+    latIndex = 0
+    lonIndex = 0
+    # process until we have reached the end of one of the series after which we cannot create more locations
+    while latIndex < len( latTs ) and lonIndex < len( lonTs ):
+        if latTs[ latIndex ] == lonTs[ lonIndex ]:
+            # same timestamp create location value and move to next in both series
+            location.append( latTs[ latIndex ], [ lon.values[ lonIndex ], lat.values[ latIndex ] ] )
+            latIndex += 1
+            lonIndex += 1
+
+        # discard which ever measurement is earlier
+        elif latTs[ latIndex ] < lonTs[ lonIndex ]:
+            latIndex += 1
             
-def saveUpdatesToFile( updates ):
+        else:
+            lonIndex += 1
+            
+    return location
+
+def _mergeToEntityUpdates( siteName, nodes ):
     '''
-    Method used in testing to save the entity updates to file.
-    Not used currently.
+    Internal method that creates the entity updates of a bus from the series of its datanodes.
+    Quantumleap requires that all attributes in a single update have the same timestamp.
+    Datanodes are updated at different times and frequencies so the measurements of all datanodes are merged to timestamp order
+    and each group of measurements with the same timestamp becomes one entity update.
+    Series must be in timestamp order.
     '''
-    for siteName, update in updates.items():
-        file = open( siteName +'.json', 'w' )
-        json.dump( update, file, indent = 4  )
-        file.close()
+    entityId = getBusId( siteName )
+    siteUpdates = [] # entity updates for the bus
+    # k-way merge of all datanodes' measurements to one stream of timestamp, datanode index, value tuples
+    # the datanode index makes sure that values are never compared to each other
+    nodeNames = list( nodes.keys() )
+    streams = [ zip( series.timestamps, repeat( index ), series.values ) for index, series in enumerate( nodes.values() ) ]
+    # attribute names and converter functions for the datanodes in the same order as the streams
+    attrNames = [ attributes[ nodeName ]['name'] for nodeName in nodeNames ]
+    nodeConverters = [ converters[ nodeName ] for nodeName in nodeNames ]
+    entity = None # entity update for the current timestamp
+    currentTs = None
+    for ts, index, value in heapq.merge( *streams ):
+        if ts != currentTs:
+            # new timestamp so the previous entity update is complete
+            if entity != None:
+                entity['id'] = entityId
+                entity['type'] = 'Vehicle'
+                siteUpdates.append( entity )
+                
+            entity = {}
+            currentTs = ts
+            
+        attribute = nodeConverters[ index ]( value, ts )
+        if attribute == None:
+            log.warning( f'No conversion mapping for {nodeNames[ index ]} value {value} of {siteName} at {datetime.fromtimestamp( ts )}.' )
+            # discard this value 
+            continue
+        
+        entity[ attrNames[ index ] ] = attribute
+        
+    if entity != None:
+        entity['id'] = entityId
+        entity['type'] = 'Vehicle'
+        siteUpdates.append( entity )
         
-def loadUpdates():
+    return siteUpdates
+
+def _createConverters():
     '''
-    Testing method used to load updates from files.
-    Not currently used.
+    Internal method that creates a converter function for each datanode from the conversion information.
+    This is done once so that the conversion information does not have to be examined for every value.
+    Returns a dictionary with datanode name as key and converter as value.
+    A converter takes a value and its timestamp in seconds and returns the attribute update
+    or None if the value cannot be converted because it has no mapping.
     '''
-    updates = {}
-    for name in busNames:
-        file = open( f'{name}.json', 'r' )
-        updates[ name ] = json.load( file )
+    converters = {}
+    for nodeName, conversionInfo in attributes.items():
+        if nodeName == 'location':
+            converters[ nodeName ] = _convertLocation
+            
+        elif 'mapping' in conversionInfo:
+            converters[ nodeName ] = _createMappingConverter( conversionInfo )
+            
+        else:
+            converters[ nodeName ] = _createValueConverter( conversionInfo )
+            
+    return converters
+
+def _convertLocation( value, ts ):
+    '''
+    Internal converter for location: creates a geo json item as the location value.
+    '''
+    return {
+        'type': 'geo:json',
+        'value': {
+            'type': 'Point',
+            'coordinates': value
+        },
+        'metadata': _createMetadata( ts )
+    }
+    
+def _createValueConverter( conversionInfo ):
+    '''
+    Internal method that creates a converter for a datanode whose values are used as is.
+    '''
+    # if type is not in conversion info we assume a number
+    attrType = conversionInfo.get( 'type', 'Number' )
+    
+    def convert( value, ts ):
+        return { 'value': value, 'type': attrType, 'metadata': _createMetadata( ts ) }
+    
+    return convert
+
+def _createMappingConverter( conversionInfo ):
+    '''
+    Internal method that creates a converter for a datanode whose values are changed according to a mapping.
+    Mapping keys are strings of the values. For integer values, which are the usual case, a table with the values as keys
+    is built so that the values do not have to be converted to strings.
+    '''
+    attrType = conversionInfo.get( 'type', 'Number' )
+    mapping = conversionInfo['mapping']
+    intMapping = {}
+    for key, mapped in mapping.items():
+        try:
+            # only keys that are exactly what str gives for the integer are used
+            # so that the result is the same as with the string mapping
+            if str( int( key )) == key:
+                intMapping[ int( key ) ] = mapped
+                
+        except ValueError:
+            pass
+    
+    def convert( value, ts ):
+        if type( value ) == int:
+            mapped = intMapping.get( value, _noMapping )
+            
+        else:
+            mapped = mapping.get( str( value ), _noMapping )
+            
+        if mapped is _noMapping:
+            return None
         
-    return updates
+        return { 'value': mapped, 'type': attrType, 'metadata': _createMetadata( ts ) }
+    
+    return convert
+
+def _createMetadata( ts ):
+    '''
+    Internal method that creates the timestamp metadata of an attribute update for a timestamp in seconds.
+    '''
+    return {
+        'timestamp': {
+            'type': 'DateTime',
+            'value': _isoTimestamp( ts )
+        }
+    }
 
+@lru_cache( maxsize = 8192 )
+def _isoTimestamp( ts ):
+    '''
+    Internal method that formats a timestamp in seconds to a UTC ISO 8601 string.
+    Cached since all the attributes of an entity update and often of other buses too share the same timestamp.
+    '''
+    return datetime.utcfromtimestamp( ts ).isoformat() +'Z'
+    
+# marks that a value has no mapping
+_noMapping = object()
+            
 # load conversion information from configuration file
 conf = config.loadConfig( 'converter.json' )
 attributes = conf['attributes']
-busNames = conf['busIDs']
\ No newline at end of file
+busNames = conf['busIDs']
+# converter functions for the datanodes
+converters = _createConverters()
\ No newline at end of file
@@ -10,12 +10,27 @@ Module responsible for operations related to FIWARE such as creating entities an
 import requests
 import time
 import json
+import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 import dataConverter
 import iotTicket
 import config
 import utils
+import sessions
+import metrics
+import tracing
+from batching import AdaptiveBatcher
+from retryPolicy import RetryPolicy
+
+try:
+    # faster JSON encoder for update payloads if it is installed
+    import orjson
+    
+except ImportError:
+    orjson = None
 
 # logger for module
 log = logging.getLogger( __name__ )
@@ -81,7 +96,7 @@ def _sendSubscription( subscription, mySubscriptions ):
     Subscription is the subscription to be created.
     mySubscription is a list where id of the created subscription is added.
     '''
-    response = requests.post( orionUri +'subscriptions', json = subscription, headers = subscriptionHeaders )
+    response = session.post( orionUri +'subscriptions', json = subscription, headers = subscriptionHeaders )
     if response.status_code == 201:
         log.info( 'subscription created' )
         mySubscriptions.append( response.headers['Location'].split( '/' )[-1])
@@ -126,7 +141,7 @@ def createEntities():
     for siteName in dataConverter.busNames.keys():
         entityId = dataConverter.getBusId( siteName )
         # see if there already is an entity with this id
-        response = requests.get( orionUri +'entities/' +entityId, headers = headers )
+        response = session.get( orionUri +'entities/' +entityId, headers = headers )
         if response.status_code == 404:
             log.info( f'{entityId} does not exist already' )
             entity = {
@@ -140,7 +155,7 @@ def createEntities():
                 'serviceProvided': { 'value': [ 'urbanTransit' ] }
             }
             
-            response = requests.post( orionUri +'entities', json = entity, headers = headers  )
+            response = session.post( orionUri +'entities', json = entity, headers = headers  )
             if response.status_code == 201:
                 log.info( 'Entity created' )
             
@@ -162,12 +177,38 @@ def sendData( updates ):
     sendEntities.count = 0
     # log how long update takes so get start time
     updateStart = time.time()    
-    updateMethod( updates )
+    # small sends one update per entity in a request so sending buses concurrently would only increase the number of requests
+    if maxRequests > 1 and len( updates ) > 1 and updateMethod != sendDataSmall:
+        _sendConcurrently( updates )
+        
+    else:
+        updateMethod( updates )
+        
     log.debug( 'Sent {0} update requests took {1:.1f} seconds'.format( sendEntities.count, time.time() -updateStart) )
     if sendToQl and updateOrion:
         # if we updated quantumleap directly send newest updates to Orion too if configured so
         _updateOrion( updates )
     
+def _sendConcurrently( updates ):
+    '''
+    Internal method that sends the updates of different buses concurrently.
+    Each bus' updates are sent by one worker with the configured update method so they arrive in timestamp order.
+    A worker takes the next bus when it is done with the previous one so a failing request is retried by its worker
+    without holding back the other buses. The update methods used here send the updates of each bus in their own requests
+    so the number of requests is the same as when sending sequentially.
+    Returns after all updates have been sent.
+    '''
+    futures = [ executor.submit( updateMethod, { siteId: entities } ) for siteId, entities in updates.items() ]
+    try:
+        for future in futures:
+            # raises the exception if sending failed
+            future.result()
+            
+    except KeyboardInterrupt:
+        # user wants to stop so tell workers to stop retrying and pass this forward
+        stop()
+        raise
+    
 def sendDataSmall( updates ):
     '''
     FIWARE update method were one update per entity at most in one request is sent.
@@ -219,6 +260,87 @@ def sendDataMedium( updates ):
                 
             sendEntities( entities[start:end] )
 
+def sendDataAdaptive( updates ):
+    '''
+    FIWARE update strategy similar to medium but the number of updates per request is not fixed.
+    It is adjusted based on the request body size, how long requests take and if requests are rejected for being too large or time out.
+    '''
+    for entities in updates.values():
+        start = 0 # index of the first update not yet sent
+        attempt = 0 # failed attempts for the current batch
+        while start < len( entities ):
+            batch = adaptiveBatcher.getBatch( entities, start )
+            uri, body, successStatus, policy = _createRequest( batch )
+            if not policy.waitUntilAvailable( _stopping ):
+                # collecting was interrupted before the updates were sent
+                raise KeyboardInterrupt()
+            
+            _countRequest()
+            requestStart = time.time()
+            retryTime = None # how long to wait before retrying if we have to wait
+            try:
+                with tracing.span( 'post', endpoint = policy.name, bus = _getBusName( batch ), entities = len( batch ), bytes = len( body )):
+                    response = session.post( uri, headers = updateHeaders, data = body, timeout = requestTimeout )
+                    
+                if response.status_code == successStatus:
+                    policy.recordSuccess()
+                    adaptiveBatcher.sent( len( batch ), len( body ), time.time() -requestStart )
+                    _countSent( batch, policy.name )
+                    start += len( batch )
+                    attempt = 0
+                    continue
+                
+                if response.status_code == 413 and len( batch ) > 1:
+                    # the request was fine just too large so retry right away with a smaller one
+                    # the endpoint did respond so it is available. This also ends a half-open circuit's trial
+                    policy.recordSuccess()
+                    log.warning( f'Update with {len( batch )} entities was too large. Retrying with a smaller batch.' )
+                    adaptiveBatcher.tooLarge( len( batch ), len( body ))
+                    continue
+                
+                if _isRejected( response.status_code ):
+                    # FIWARE is available but does not accept these updates so skip them
+                    policy.recordSuccess()
+                    _dropRejected( batch, policy.name, response )
+                    start += len( batch )
+                    attempt = 0
+                    continue
+                
+                attempt += 1
+                retryTime = policy.getDelay( attempt )
+                log.error( f'Update failed code: {response.status_code}. Retrying after {retryTime:.1f} seconds.' )
+                log.error( response.text )
+                
+            except KeyboardInterrupt:
+                # user wants to stop so raise
+                raise
+            
+            except requests.exceptions.Timeout:
+                attempt += 1
+                adaptiveBatcher.timedOut( len( batch ))
+                if len( batch ) == 1:
+                    # cannot get any smaller so the problem is somewhere else and we should wait before retrying
+                    retryTime = policy.getDelay( attempt )
+                    log.warning( f'Update timed out. Retrying after {retryTime:.1f} seconds.' )
+                    
+                else:
+                    # the batch may just be too large so this does not tell that the endpoint is unavailable
+                    log.warning( f'Update with {len( batch )} entities timed out. Retrying with a smaller batch.' )
+                    policy.recordInconclusive()
+                    continue
+            
+            except:
+                attempt += 1
+                retryTime = policy.getDelay( attempt )
+                log.exception( f'Exception when updating FIWARE. Retrying after {retryTime:.1f} seconds.' )
+                
+            finally:
+                metrics.requestDuration.observe( time.time() -requestStart, endpoint = policy.name )
+                
+            policy.recordFailure()
+            if retryTime != None:
+                _stopping.wait( retryTime )
+                
 def _updateOrion( updates ):
     '''
     Send latest entity updates in updates to Orion.
@@ -270,62 +392,184 @@ def sendEntities( entities, useQl = None ):
         log.debug( 'sendEntities got entity list with 0 entities. No need to send it.' )
         return
     
+    # keep count how many request we are sending        
+    _countRequest()
+    # the body is serialized once and the same bytes are sent again if the request has to be retried
+    uri, body, successStatus, policy = _createRequest( entities, useQl )
+    attempt = 0 # number of failed attempts so far
+    while policy.waitUntilAvailable( _stopping ):
+        requestStart = time.time()
+        try:
+            with tracing.span( 'post', endpoint = policy.name, bus = _getBusName( entities ), entities = len( entities ), bytes = len( body )):
+                response = session.post( uri, headers = updateHeaders, data = body, timeout = requestTimeout )
+                
+            if response.status_code == successStatus:
+                policy.recordSuccess()
+                _countSent( entities, policy.name )
+                return # success
+            
+            if _isRejected( response.status_code ):
+                # FIWARE is available but does not accept these updates so retrying does not help
+                policy.recordSuccess()
+                _dropRejected( entities, policy.name, response )
+                return
+            
+            attempt += 1
+            retryTime = policy.getDelay( attempt )
+            log.error( f'Update failed code: {response.status_code}. Retrying after {retryTime:.1f} seconds.' )
+            log.error( response.text )
+                
+        except KeyboardInterrupt:
+            # user wants to stop so raise
+            raise
+         
+        except:
+            attempt += 1
+            retryTime = policy.getDelay( attempt )
+            log.exception( f'Exception when updating FIWARE. Retrying after {retryTime:.1f} seconds.' )
+            
+        finally:
+            metrics.requestDuration.observe( time.time() -requestStart, endpoint = policy.name )
+        
+        policy.recordFailure()
+        # wait before retrying unless we are told to stop
+        _stopping.wait( retryTime )
+        
+    # collecting was interrupted before the updates were sent
+    raise KeyboardInterrupt()
+        
+def _isRejected( statusCode ):
+    '''
+    Internal method that checks if the response status code tells that FIWARE rejected the updates themselves
+    i.e. a client error other than a timeout or too many requests.
+    '''
+    return 400 <= statusCode < 500 and statusCode not in ( 408, 429 )
+
+def _dropRejected( entities, endpoint, response ):
+    '''
+    Internal method that logs and counts entity updates that FIWARE rejected and which are therefore not sent.
+    '''
+    log.error( f'Update rejected code: {response.status_code}. Dropping {len( entities )} entity updates.' )
+    log.error( response.text )
+    for entity in entities:
+        metrics.updatesRejected.inc( bus = entity['id'].split( ':' )[-1], endpoint = endpoint )
+        
+def _countRequest():
+    '''
+    Internal method that increases the count of sent requests.
+    Requests may be sent from multiple threads so a lock is used.
+    '''
+    with _countLock:
+        sendEntities.count = sendEntities.count +1
+        
+def _countSent( entities, endpoint ):
+    '''
+    Internal method that adds the number of attribute updates sent to the endpoint for each bus to the metrics.
+    '''
+    counts = {} # attribute updates by bus name
+    for entity in entities:
+        # id is for example Vehicle:TKL14 and every key except id and type is an attribute
+        busName = entity['id'].split( ':' )[-1]
+        counts[ busName ] = counts.get( busName, 0 ) +len( entity ) -2
+        
+    for busName, count in counts.items():
+        metrics.measurementsSent.inc( count, bus = busName, endpoint = endpoint )
+        
+def _getBusName( entities ):
+    '''
+    Internal method that gets the name of the bus the entity updates are for or None if they are for multiple buses.
+    Updates of a bus are together so it is enough to check the first and the last one.
+    '''
+    if entities[0]['id'] != entities[-1]['id']:
+        return None
+    
+    return entities[0]['id'].split( ':' )[-1]
+        
+def _createRequest( entities, useQl = None ):
+    '''
+    Internal method that creates the update request for the given entity updates.
+    UseQl works the same way as in sendEntities.
+    Returns the URL, serialized request body, status code of a successful request and the retry policy of the endpoint.
+    '''
     if useQl == None:
         # if no value use one from configuration
         useQl = sendToQl
 
-    # keep count how many request we are sending        
-    sendEntities.count = sendEntities.count +1
-    
     # url we are sending the updates assume Orion first
     uri = orionUri +'op/update'
     # request body attribute that has the entities
     entityAttr = 'entities'
     # status code of successfull request
     successStatus = 204
+    policy = orionRetryPolicy
     
     if useQl:
         uri = qlUri +'notify'
         entityAttr = 'data'
         successStatus = 200
+        policy = qlRetryPolicy
         
     payload = {} # request payload
     payload[entityAttr] = entities
     if not useQl:
         # Orion batch update type
         payload['actionType'] = 'append'
-    
-    #file = open( 'payload' +str(sendEntities.count) +'.json', 'w' )
-    #json.dump( payload, file, indent = 4 )
-    #file.close()
-    retryTime = 10 # in case of failure how long to wait before retrying
-    while True:
-        try:
-            response = requests.post( uri, headers = headers, json = payload, timeout = 120 )
-            if response.status_code != successStatus:
-                log.error( f'Update failed code: {response.status_code}. Retrying after {retryTime} seconds.' )
-                log.error( response.text )
         
-            else:
-                break # success
-                
-        except KeyboardInterrupt:
-            # user wants to stop so raise
-            raise
-         
-        except:
-            log.exception( f'Exception when updating FIWARE. Retrying after {retryTime} seconds.' )
+    with tracing.span( 'encode', entities = len( entities )):
+        body = _serialize( payload )
+        
+    return uri, body, successStatus, policy
+
+def _serialize( payload ):
+    '''
+    Internal method that serializes an update request payload to the bytes sent as the request body.
+    Uses orjson if it is available. The body is compressed with gzip if configured so.
+    '''
+    if orjson != None:
+        body = orjson.dumps( payload )
+        
+    else:
+        body = json.dumps( payload, separators = ( ',', ':' ), ensure_ascii = False ).encode( 'utf-8' )
+        
+    if gzipRequests:
+        # updates have lots of repeated attribute names, timestamps and metadata so they compress well
+        body = gzip.compress( body, compresslevel = gzipLevel )
         
-        time.sleep( retryTime )
+    return body
+        
+def waitUntilAvailable():
+    '''
+    Wait until the FIWARE endpoints updates are sent to are considered to be available.
+    Used to pause collecting while FIWARE is down instead of fetching measurements that cannot be sent.
+    Returns False if collecting was stopped while waiting.
+    '''
+    # the endpoints updates are sent to depend on the configuration
+    policies = [ qlRetryPolicy ] if sendToQl else [ orionRetryPolicy ]
+    if sendToQl and updateOrion:
+        policies.append( orionRetryPolicy )
+        
+    for policy in policies:
+        # the trial request of a circuit is left to the sender
+        if not policy.waitWhileOpen( _stopping ):
+            return False
+        
+    return True
+    
+def stop():
+    '''
+    Tells sendEntities to stop retrying failed requests.
+    Used when collecting is stopped while updates are sent from another thread.
+    '''
+    _stopping.set()
         
 def deleteAllSubscriptions():
     '''
     Deletes all subscriptions from Orion. Not just those created by this tool.
     Not used anywhere. Can be used when testing.
     '''
-    response = requests.get( orionUri +'subscriptions', headers = subscriptionHeaders )
+    response = session.get( orionUri +'subscriptions', headers = subscriptionHeaders )
     for subscription in response.json():
-        deleteResp = requests.delete( orionUri +'subscriptions/' +subscription['id'], headers = subscriptionHeaders )
+        deleteResp = session.delete( orionUri +'subscriptions/' +subscription['id'], headers = subscriptionHeaders )
         print( str( deleteResp.status_code ) +' status code when removing subscription ' +str( subscription['id']) )
 
 def deleteAll():
@@ -339,7 +583,7 @@ def deleteAll():
             mySubscriptions = subscriptions.get( orionUri )
             if mySubscriptions != None:
                 for subscriptionId in mySubscriptions:
-                    deleteResp = requests.delete( orionUri +'subscriptions/' +subscriptionId, headers = subscriptionHeaders )
+                    deleteResp = session.delete( orionUri +'subscriptions/' +subscriptionId, headers = subscriptionHeaders )
                     print( str( deleteResp.status_code ) +' status code when removing subscription ' +subscriptionId )
                     
                 del subscriptions[orionUri]
@@ -349,9 +593,9 @@ def deleteAll():
         pass
     
     for entityId in [ dataConverter.getBusId( name ) for name in dataConverter.busNames ]:
-        response = requests.delete( orionUri +'entities/' +entityId, headers = headers )
+        response = session.delete( orionUri +'entities/' +entityId, headers = headers )
         print( f'{response.status_code} status code when removing {entityId} from orion.' )
-        response = requests.delete( qlUri +'entities/' +entityId, headers = headers )
+        response = session.delete( qlUri +'entities/' +entityId, headers = headers )
         print( f'{response.status_code} status code when removing {entityId} from Quantumleap.' )        
         
 def checkUpdates( updates ):
@@ -379,7 +623,7 @@ def checkUpdates( updates ):
         params['fromDate'] = getTime( values[0] )
         params['toDate'] = getTime( values[-1] )
         
-        response = requests.get( f'{qlUri}entities/{entityId}', headers = headers, params = params )
+        response = session.get( f'{qlUri}entities/{entityId}', headers = headers, params = params )
         if response.status_code != 200:
             log.warning( f'{response.status_code} status code when getting measurements from quantumleap for entity {entityId}. ')
             continue
@@ -396,6 +640,9 @@ def checkUpdates( updates ):
 
 # used to keep count how many requests have been send        
 sendEntities.count = 0
+_countLock = threading.Lock()
+# set when collecting is stopped so that failed requests are no longer retried
+_stopping = threading.Event()
 
 # load configuration
 conf = config.loadConfig( 'fiware.json' )
@@ -405,22 +652,54 @@ qlUri = conf['quantumleap_URL']
 headers = conf.get( 'custom_headers', {} )
 headers['Fiware-Service'] = conf['service']
 headers['Fiware-ServicePath'] = conf['service_path']
+# should update request bodies be compressed with gzip
+gzipRequests = conf.get( 'gzip_requests', False )
+# compression level used: lower is faster and higher compresses more
+gzipLevel = conf.get( 'gzip_level', 6 )
+# headers for update requests whose bodies are sent as already serialized JSON
+updateHeaders = dict( headers )
+updateHeaders['Content-Type'] = 'application/json'
+if gzipRequests:
+    updateHeaders['Content-Encoding'] = 'gzip'
+    
 # when dealing with subscriptions service path is not required
 subscriptionHeaders = dict( headers )
 del subscriptionHeaders['Fiware-ServicePath']
 
+# maximum number of update requests sent concurrently each for a different bus
+maxRequests = conf.get( 'max_concurrent_requests', 1 )
+# workers that send the updates of different buses concurrently
+executor = ThreadPoolExecutor( max_workers = maxRequests, thread_name_prefix = 'fiware-send' )
+# session used for all requests to FIWARE so that connections are reused
+# it has a connection for each concurrent request
+session = sessions.createSession( maxRequests )
+
 sendToQl = conf['send_to_ql']
 qlMultipleNotify = conf['ql_multiple_notify']
 updateOrion = conf['update_orion']
 updateStrategy = conf['update_strategy']
 createAttributeSubscriptions = conf['create_attribute_subscriptions']
+# how failed requests to Orion and QuantumLeap are retried
+retryConf = conf.get( 'retry', {} )
+orionRetryPolicy = RetryPolicy( 'Orion', retryConf.get( 'orion' ))
+qlRetryPolicy = RetryPolicy( 'QuantumLeap', retryConf.get( 'quantumleap' ))
+# timeout in seconds for update requests
+requestTimeout = 120
+# settings for the adaptive update strategy
+adaptiveConf = conf.get( 'adaptive', {} )
+adaptiveBatcher = AdaptiveBatcher( targetBytes = adaptiveConf.get( 'target_bytes', 1000000 ),
+                                   targetLatency = adaptiveConf.get( 'target_latency', 2.0 ),
+                                   minBatch = adaptiveConf.get( 'min_batch', 1 ),
+                                   maxBatch = adaptiveConf.get( 'max_batch', 5000 ),
+                                   initialBatch = adaptiveConf.get( 'initial_batch', 600 ))
 
 # determine how FIWARE is updated based on configuration
 # Different ways of making the updates an corresponding methods for do in so.
 updateMethods = {
     'small': sendDataSmall,
     'medium': sendDataMedium,
-    'simple': sendDataSimple
+    'simple': sendDataSimple,
+    'adaptive': sendDataAdaptive
 }
 
 updateMethod = updateMethods.get( updateStrategy )
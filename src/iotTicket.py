@@ -9,10 +9,21 @@ This module is responsible for fetching measurements from IoT-Ticket.
 
 import time
 import json
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime
 import dataConverter
 import config
-import requests
+import checkpoint
+import sessions
+import jsonStream
+import metrics
+import tracing
+from series import Series
+from utils import s2mrs
+from retryPolicy import RetryPolicy
 import logging
 
 # logger for the module
@@ -26,84 +37,568 @@ def getDataNodes():
     '''
     Get the datanodes for all bus sites.
     Has to be called once before getData.
+    Datanodes saved to the datanode cache by an earlier run are used right away and only the sites missing from it
+    are requested from IoT-Ticket. They are requested concurrently.
+    If refreshing is configured the datanodes of each site are requested again in a background thread when they get older than the refresh interval.
     '''
-    # Get ids of all sites that have bus data and get their datanodes
+    cache = _loadNodeCache()
+    misses = [] # sites not in the cache
     for siteId in dataConverter.busNames.keys():
-        # list for datanodes of the site
-        siteNodes = []
+        if siteId in cache:
+            dataNodes[ siteId ] = _filterNodes( cache[ siteId ]['nodes'] )
+            _siteNodes[ siteId ] = cache[ siteId ]
+            
+        else:
+            misses.append( siteId )
+            
+    if len( misses ) > 0:
+        log.info( f'Getting datanodes of {len( misses )} sites from IoT-Ticket.' )
+        futures = { siteId: executor.submit( _fetchSiteNodes, siteId ) for siteId in misses }
+        for siteId, future in futures.items():
+            nodes = future.result()
+            if nodes == None:
+                # the site or credentials are wrong so collecting cannot be done
+                exit()
+                
+            _setSiteNodes( siteId, nodes )
+            
+        _saveNodeCache()
+        
+    if refreshInterval > 0:
+        threading.Thread( target = _refreshNodes, name = 'datanode-refresh', daemon = True ).start()
+        
+def _fetchSiteNodes( siteId ):
+    '''
+    Internal method that gets all datanodes of a site from IoT-Ticket.
+    Retries according to the retry policy if the request fails.
+    Returns None if IoT-Ticket tells that the request is invalid for example because the site does not exist.
+    '''
+    attempt = 0 # number of failed attempts so far
+    while retryPolicy.waitUntilAvailable( _stopping ):
+        requestStart = time.time()
+        try:
+            # limit 50 is enough here since a bus has at most about 20 datanodes
+            response = session.get( f'{baseUrl}sites/{siteId}/datanodes', params = { 'expand': 'name', 'limit': 50 }, timeout = 120 )
+            if response.status_code == 200:
+                nodes = response.json()['items']
+                retryPolicy.recordSuccess()
+                return nodes
+            
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                # retrying does not help. IoT-Ticket did respond so it is available
+                retryPolicy.recordSuccess()
+                log.error( f'Unable to get datanodes for site {siteId} from IoT-Ticket. HTTP status code {response.status_code}')
+                log.error( response.text )
+                return None
+            
+            attempt += 1
+            retryTime = retryPolicy.getDelay( attempt )
+            log.error( f'Failed to get datanodes for site {siteId} from IoT-Ticket. HTTP status code: {response.status_code}. Retrying after {retryTime:.1f} seconds.' )
+            
+        except:
+            attempt += 1
+            retryTime = retryPolicy.getDelay( attempt )
+            log.exception( f'Exception when getting datanodes for site {siteId} from IoT-Ticket. Retrying after {retryTime:.1f} seconds.')
+            
+        finally:
+            metrics.requestDuration.observe( time.time() -requestStart, endpoint = retryPolicy.name )
+            
+        retryPolicy.recordFailure()
+        _stopping.wait( retryTime )
+        
+    raise KeyboardInterrupt()
+    
+def _filterNodes( nodes ):
+    '''
+    Internal method that gets the datanodes we collect from the given datanodes.
+    '''
+    # add only those nodes, we have conversion information for, and longitude and latitude which are handled separately from other conversions
+    names = list( dataConverter.attributes.keys()) +[ 'Latitude', 'Longitude' ]
+    return [ node for node in nodes if node['name'] in names ]
+    
+def _setSiteNodes( siteId, nodes ):
+    '''
+    Internal method that sets the datanodes of a site to the given datanodes got from IoT-Ticket.
+    Logs the datanodes that were added or removed since the previous time.
+    '''
+    siteNodes = _filterNodes( nodes )
+    with _nodesLock:
+        if siteId in dataNodes:
+            oldNames = { node['name'] for node in dataNodes[ siteId ] }
+            newNames = { node['name'] for node in siteNodes }
+            if oldNames != newNames:
+                log.info( f'Datanodes of site {siteId} changed. Added: {sorted( newNames -oldNames )} removed: {sorted( oldNames -newNames )}.' )
+            
+        # the list is replaced instead of changed so that measurements being fetched with the old list are not affected
         dataNodes[ siteId ] = siteNodes
-        # limit 50 is enough here since a bus has at most about 20 datanodes
-        response = requests.get( f'{baseUrl}sites/{siteId}/datanodes', auth = auth, params = { 'expand': 'name', 'limit': 50 } )
-        if response.status_code != 200:
-            log.error( f'Unable to get datanodes for site {siteId} from IoT-Ticket. HTTP status code {response.status_code}')
-            log.error( response.text )
-            exit()
+        _siteNodes[ siteId ] = { 'fetched': time.time(), 'nodes': nodes }
+        
+def _refreshNodes():
+    '''
+    Internal method run by the refresh thread.
+    Gets the datanodes of the sites whose datanodes are older than the refresh interval again until collecting is stopped.
+    '''
+    while True:
+        try:
+            refreshed = False
+            for siteId, cached in list( _siteNodes.items() ):
+                if time.time() -cached['fetched'] < refreshInterval:
+                    continue
+                
+                # the worker pool is used so that the requests do not exceed the maximum number of concurrent requests
+                nodes = executor.submit( _fetchSiteNodes, siteId ).result()
+                if nodes == None:
+                    # keep the old ones and try again after the interval
+                    cached['fetched'] = time.time()
+                    continue
+                
+                _setSiteNodes( siteId, nodes )
+                refreshed = True
+                
+            if refreshed:
+                _saveNodeCache()
+                
+        except KeyboardInterrupt:
+            # collecting was stopped
+            return
+        
+        except:
+            log.exception( 'Refreshing datanodes failed.' )
+            
+        if _stopping.wait( min( refreshInterval, 60 )):
+            return
+        
+def _loadNodeCache():
+    '''
+    Internal method that loads the datanodes of each site from the datanode cache.
+    Returns a dictionary with site id as key and value a dictionary with the datanodes and when they were got.
+    The cache is not used if it is for another IoT-Ticket.
+    '''
+    if not useNodeCache:
+        return {}
+    
+    try:
+        with open( nodeCacheFile, 'r' ) as file:
+            cache = json.load( file )
             
-        for node in response.json()['items']:
-            # add only those nodes, we have conversion information for, and longitude and latitude which are handled separately from other conversions
-            if node['name'] not in list( dataConverter.attributes.keys()) +[ 'Latitude', 'Longitude' ]:
-                continue
+    except FileNotFoundError:
+        return {}
+    
+    except ValueError:
+        log.warning( f'Datanode cache {nodeCacheFile} is not valid. Getting all datanodes from IoT-Ticket.' )
+        return {}
+        
+    if cache.get( 'url' ) != baseUrl:
+        return {}
+    
+    return cache['sites']
+    
+def _saveNodeCache():
+    '''
+    Internal method that saves the datanodes of each site to the datanode cache.
+    The file is first written with a temporary name so that there never is a partially written cache.
+    '''
+    if not useNodeCache:
+        return
+    
+    with _nodesLock:
+        cache = { 'url': baseUrl, 'sites': dict( _siteNodes ) }
+        nodeCacheFile.parent.mkdir( parents = True, exist_ok = True )
+        tempFile = nodeCacheFile.with_suffix( '.tmp' )
+        with open( tempFile, 'w' ) as file:
+            json.dump( cache, file )
             
-            siteNodes.append( node )
+        os.replace( str( tempFile ), str( nodeCacheFile ))
             
-def getData( begin, end ):
+def getData( begin, end, horizon = None, siteIds = None ):
     """
     Get measurements for all buses' datanodes, we have conversion information, for a given time period.
     Begin and end are the start and end times as unix timestamps as microseconds. They must be integers.
-    Difference between begin and end cannot be too long since we get measurements for a datanode with just one 
-    request and there is a limit for how many measurements we can get. 2 hours is at least a suitable difference.
+    If a response has as many measurements as can be requested at once the rest are requested in further requests.
+    Requests for the datanodes are done concurrently with at most max_concurrent_requests from the configuration in flight at once.
+    Horizon is the latest time in microseconds measurements can be fetched for. If it is given and prefetching is configured
+    measurements of a datanode are fetched past end up to horizon based on how often the datanode gets measurements.
+    They are cached and returned by later calls so sparse datanodes are not requested for every period.
+    SiteIds is a list of the sites whose measurements are fetched. By default measurements of all sites are fetched.
+    If the freshness probe is used datanodes whose latest measurement is older than begin are not requested.
     Returns a dictionary with site id as a key. Value is another dictionary with datanode name as the key
-    and value list containing value (v) timestamp (ts) dictionaries.
+    and value a Series containing the measurements of the datanode.
     GetDataNodes has to be called before using this for the first time.
     """
-    data = {} # the return value
     # we want to log how long getting data for all datanodes takes so get the current time before we start
     startTime = time.time()
+    if freshnessProbe:
+        _probe( begin, end, siteIds )
+        
+    data, futures = _submitRequests( begin, end, horizon, siteIds )
+    try:
+        for future, siteData, nodeName in futures:
+            siteData[ nodeName ] = future.result()
+            
+    except KeyboardInterrupt:
+        # user wants to stop collecting so tell the workers to give up retrying and pass this forward
+        stop()
+        for future, siteData, nodeName in futures:
+            future.cancel()
+            
+        raise
+            
+    log.debug( f'Measurements fetched in {time.time() -startTime:.1f} seconds.' )
+    _countFetched( data )
+    return data
+    
+async def getDataAsync( begin, end, horizon = None, siteIds = None ):
+    '''
+    Asyncio version of getData with the same parameters and return value.
+    The requests are done by the same worker pool so the event loop is free to do other things while waiting for the measurements.
+    '''
+    startTime = time.time()
+    if freshnessProbe:
+        await _probeAsync( begin, end, siteIds )
+        
+    data, futures = _submitRequests( begin, end, horizon, siteIds )
+    results = await asyncio.gather( *[ asyncio.wrap_future( future ) for future, siteData, nodeName in futures ] )
+    for ( future, siteData, nodeName ), items in zip( futures, results ):
+        siteData[ nodeName ] = items
+        
+    log.debug( f'Measurements fetched in {time.time() -startTime:.1f} seconds.' )
+    _countFetched( data )
+    return data
+    
+def getLatestData():
+    '''
+    Get the latest measurement of each datanode of all buses with one request per bus.
+    The datanodes of a site are requested with their latest processdata which is much lighter than requesting the processdata
+    of each datanode separately. The requests are done concurrently by the same worker pool as in getData.
+    Returns a dictionary in the same format as getData. The Series of a datanode has its latest measurement
+    or is empty if the datanode has no measurements.
+    GetDataNodes has to be called before using this for the first time.
+    '''
+    futures = { siteId: executor.submit( _getSiteLatest, siteId, nodes ) for siteId, nodes in list( dataNodes.items() ) }
+    data = {}
+    try:
+        for siteId, future in futures.items():
+            data[ siteId ] = future.result()
+            
+    except KeyboardInterrupt:
+        stop()
+        for future in futures.values():
+            future.cancel()
+            
+        raise
+    
+    _countFetched( data )
+    return data
+    
+def stop():
+    '''
+    Tells the workers to stop retrying failed requests.
+    Used when collecting is stopped.
+    '''
+    _stopping.set()
+    
+def _submitRequests( begin, end, horizon, siteIds ):
+    '''
+    Internal method that submits requests for measurements of all datanodes of the given sites, or all sites if None, between begin and end to the worker pool.
+    Returns the result dictionary with empty site dictionaries and a list of futures.
+    Each future is in a tuple with the site dictionary and datanode name the result of the future belongs to
+    so that the result has the same structure and order as when fetching one datanode at a time.
+    '''
+    data = {} # the return value
     # we have to make a separate request for each datanode we want measurements for
-    # request parameters¨: the begin and end times
-    # also use maximum amount for limit i.e. the number of values fetched
-    # the real maximum amount of values seen is a lot less about 13000 measurements
-    params = {
-        'begin': begin,
-        'end': end,
-        'limit': 100000
-    }
-
-    retryTime = 10 # if request fails how long to wait before retrying    
-    for siteId, nodes in dataNodes.items():
+    futures = []
+    if siteIds == None:
+        siteIds = dataNodes.keys()
+        
+    for siteId in siteIds:
         siteData = {} # for site's measurements
         data[siteId] = siteData
-        for node in nodes:
-            # might have to try the request multiple times if we encounter errors
-            retrying = False # is this a retry of a previously failed attempt
-            while True:
-                headers = { 'Accept-Encoding': 'gzip, deflate' }
-                # for some reason the above requests default header causes an issue
-                # with some requests so if we had an error with this request before lets not use it
-                if retrying:
-                    headers['Accept-Encoding'] = None
-                    
-                try:
-                    processdata = requests.get( node['href'] +'/processdata', auth = auth, params = params, headers = headers, timeout = 120 )
-                    if processdata.status_code == 200:
-                        siteData[ node['name'] ] = processdata.json().get('items', [] )
-                        break # done got the data
-                    
-                    log.error( f'Failed to get measurements from IoT-Ticket. HTTP status code: {processdata.status_code}. Retrying after {retryTime} seconds.' )
-                    log.error( processdata.text )
-                    
-                except KeyboardInterrupt:
-                    # user wants to stop collecting so make sure this is passed forward
-                    raise
+        for node in dataNodes[ siteId ]:
+            if freshnessProbe and _isIdle( node['href'], begin, end ):
+                # nothing to fetch but the result is a future like the others so that the order of the datanodes stays the same
+                future = Future()
+                future.set_result( Series() )
+                metrics.fetchesSkipped.inc( bus = dataConverter.getBusName( siteId ))
+                
+            else:
+                future = executor.submit( _getNodeData, node, begin, end, horizon, siteId )
+                
+            futures.append(( future, siteData, node['name'] ))
+            
+    return data, futures
+    
+def _probe( begin, end, siteIds ):
+    '''
+    Internal method that updates the freshness index for the sites, or all sites if None, that have datanodes
+    for which the index does not tell if they can have measurements between begin and end.
+    The latest measurements of all datanodes of a site are got with one request.
+    '''
+    probeTime, futures = _submitProbes( begin, end, siteIds )
+    try:
+        for future, nodes in futures:
+            _updateFreshness( nodes, future.result(), probeTime )
+                
+    except KeyboardInterrupt:
+        stop()
+        for future, nodes in futures:
+            future.cancel()
+            
+        raise
+    
+async def _probeAsync( begin, end, siteIds ):
+    '''
+    Internal asyncio version of _probe.
+    '''
+    probeTime, futures = _submitProbes( begin, end, siteIds )
+    results = await asyncio.gather( *[ asyncio.wrap_future( future ) for future, nodes in futures ] )
+    for ( future, nodes ), latest in zip( futures, results ):
+        _updateFreshness( nodes, latest, probeTime )
+        
+def _submitProbes( begin, end, siteIds ):
+    '''
+    Internal method that submits the requests for the latest measurements of the sites that need probing to the worker pool.
+    Returns the probe time and a list of futures each in a tuple with the datanodes of the site the future belongs to.
+    '''
+    if siteIds == None:
+        siteIds = list( dataNodes.keys() )
+        
+    # the same datanodes are used for the whole probe even if the datanodes are refreshed meanwhile
+    siteNodes = { siteId: dataNodes[ siteId ] for siteId in siteIds }
+    probeSites = [ siteId for siteId in siteIds if any( _needsProbe( node['href'], begin, end ) for node in siteNodes[ siteId ] ) ]
+    # measurements that have arrived by now are included in the results
+    probeTime = s2mrs( time.time() )
+    futures = [ ( executor.submit( _getSiteLatest, siteId, siteNodes[ siteId ] ), siteNodes[ siteId ] ) for siteId in probeSites ]
+    return probeTime, futures
+    
+def _updateFreshness( nodes, latest, probeTime ):
+    '''
+    Internal method that updates the freshness index of the datanodes from their latest measurements got at probeTime.
+    '''
+    for node in nodes:
+        series = latest[ node['name'] ]
+        # a datanode without any measurements is idle until it gets one
+        latestTs = series.timestamps[0] if len( series ) > 0 else -1
+        _freshness[ node['href'] ] = ( latestTs, probeTime )
+    
+def _isIdle( href, begin, end ):
+    '''
+    Internal method that checks from the freshness index if a datanode certainly has no measurements between begin and end.
+    That is the case if its latest measurement is before begin and it was probed late enough that
+    all measurements until end had arrived to IoT-Ticket.
+    '''
+    entry = _freshness.get( href )
+    return entry != None and entry[0] < begin and entry[1] >= end +arrivalMargin
+
+def _needsProbe( href, begin, end ):
+    '''
+    Internal method that checks if the freshness index does not know if a datanode can have measurements between begin and end.
+    A datanode whose latest known measurement is at or after begin does not need probing since it has to be fetched anyway.
+    '''
+    entry = _freshness.get( href )
+    return entry == None or ( entry[0] < begin and entry[1] < end +arrivalMargin )
+    
+def _getNodeData( node, begin, end, horizon, siteId ):
+    '''
+    Internal method used by the worker pool to get measurements of one datanode between begin and end.
+    Node is the datanode from dataNodes of the site with siteId. Horizon is as in getData.
+    Measurements already prefetched are taken from the node's cache and only the rest are requested.
+    Returns the measurements as a Series.
+    '''
+    # each datanode is fetched by one worker at a time so its cache and density are not shared between threads
+    href = node['href']
+    cache = _caches.pop( href, None )
+    measurements = Series()
+    fetchBegin = begin
+    if cache != None and cache.begin <= begin <= cache.until +1:
+        # the cache has the measurements from its begin to its until
+        cached, rest = cache.series.split( end )
+        # drop cached measurements before begin if the previous period was not the one just before this
+        measurements = cached.split( begin -1 )[1]
+        fetchBegin = cache.until +1
+        if end <= cache.until:
+            # everything was in the cache
+            _caches[ href ] = _NodeCache( end +1, cache.until, rest )
+            return measurements
+        
+    fetchEnd = _getFetchEnd( href, fetchBegin, end, horizon )
+    fetched = _fetchNodeData( node, fetchBegin, fetchEnd, siteId )
+    _updateDensity( href, len( fetched ), fetchEnd -fetchBegin +1 )
+    if fetchEnd > end:
+        fetched, rest = fetched.split( end )
+        _caches[ href ] = _NodeCache( end +1, fetchEnd, rest )
+        
+    measurements.extend( fetched )
+    return measurements
+    
+def _getFetchEnd( href, begin, end, horizon ):
+    '''
+    Internal method that determines until when the measurements of a datanode are fetched when they are needed from begin to end.
+    The window is long enough to have about prefetch_target_items measurements at the datanode's measurement density.
+    Nothing is prefetched until the density of the datanode is known.
+    '''
+    density = _densities.get( href )
+    if horizon == None or horizon <= end or prefetchTargetItems == 0 or density == None:
+        return end
+    
+    # measurements per microsecond so the window is in microseconds
+    window = min( prefetchTargetItems /density if density > 0 else maxPrefetch, maxPrefetch )
+    return max( end, min( begin +round( window ) -1, horizon ))
+    
+def _updateDensity( href, count, length ):
+    '''
+    Internal method that updates the measurement density of a datanode after count measurements were fetched for a period of the given length in microseconds.
+    The density is a moving average so that a single quiet or busy period does not change it too much.
+    '''
+    density = count /length
+    previous = _densities.get( href )
+    if previous != None:
+        density = ( previous +density ) /2
+        
+    _densities[ href ] = density
+    
+def _fetchNodeData( node, begin, end, siteId ):
+    '''
+    Internal method that requests the measurements of one datanode between begin and end.
+    If a response has page_limit measurements there may be more of them so the rest are requested starting after the last one received.
+    Returns the measurements as a Series.
+    '''
+    measurements = Series()
+    while True:
+        page = _requestNodeData( node, { 'begin': begin, 'end': end, 'limit': pageLimit }, siteId )
+        measurements.extend( page )
+        if len( page ) < pageLimit:
+            return measurements
+        
+        # the measurements are in ascending order
+        log.debug( f'Got a full page of {len( page )} measurements for {node["name"]} of site {siteId}. Requesting the rest.' )
+        begin = page.timestamps[-1] +1
+        
+def _requestNodeData( node, params, siteId ):
+    '''
+    Internal method that does one processdata request for the measurements of a datanode.
+    Node is the datanode from dataNodes of the site with siteId and params are the processdata request parameters.
+    Retries according to the retry policy until the measurements are received. Only the calling worker waits between retries.
+    Returns the measurements as a Series.
+    '''
+    # might have to try the request multiple times if we encounter errors
+    attempt = 0 # number of failed attempts so far
+    while retryPolicy.waitUntilAvailable( _stopping ):
+        headers = { 'Accept-Encoding': 'gzip, deflate' }
+        # for some reason the above requests default header causes an issue
+        # with some requests so if we had an error with this request before lets not use it
+        if attempt > 0:
+            headers['Accept-Encoding'] = None
+            
+        requestStart = time.time()
+        try:
+            with tracing.span( 'request', bus = dataConverter.getBusName( siteId ), node = node['name'], begin = params['begin'], end = params['end'] ):
+                processdata = session.get( node['href'] +'/processdata', params = params, headers = headers, timeout = 120, stream = streamingParse )
+                if processdata.status_code == 200:
+                    # done got the data
+                    if streamingParse:
+                        measurements = _parseStream( processdata )
                         
-                except:
-                    log.exception( f'Exception when getting measurements from IoT-Ticket. Retrying after {retryTime} seconds.')
-                    
-                time.sleep( retryTime )
-                retrying = True
+                    else:
+                        measurements = Series.fromItems( processdata.json().get('items', [] ))
+                        
+                    retryPolicy.recordSuccess()
+                    return measurements
+                
+            attempt += 1
+            retryTime = retryPolicy.getDelay( attempt )
+            log.error( f'Failed to get measurements from IoT-Ticket. HTTP status code: {processdata.status_code}. Retrying after {retryTime:.1f} seconds.' )
+            log.error( processdata.text )
             
-    log.debug( f'Measurements fetched in {time.time() -startTime:.1f} seconds.' )
-    return data
+        except:
+            attempt += 1
+            retryTime = retryPolicy.getDelay( attempt )
+            log.exception( f'Exception when getting measurements from IoT-Ticket. Retrying after {retryTime:.1f} seconds.')
+            
+        finally:
+            metrics.requestDuration.observe( time.time() -requestStart, endpoint = retryPolicy.name )
+            
+        retryPolicy.recordFailure()
+        # wait before retrying unless we are told to stop
+        _stopping.wait( retryTime )
+        
+    # collecting was interrupted so pass it on instead of returning measurements we do not have
+    raise KeyboardInterrupt()
+    
+class _NodeCache():
+    '''
+    Internal class for measurements of a datanode prefetched past the period they were requested for.
+    Series has the measurements from begin to until which are unix timestamps in microseconds.
+    '''
+    
+    def __init__(self, begin, until, series ):
+        self.begin = begin
+        self.until = until
+        self.series = series
+        
+def _getSiteLatest( siteId, nodes ):
+    '''
+    Internal method used by the worker pool to get the latest measurements of the given datanodes of one site.
+    Retries according to the retry policy until the measurements are received.
+    Returns a dictionary with datanode name as key and a Series with the latest measurement as value.
+    '''
+    # only the datanodes we collect are returned
+    names = [ node['name'] for node in nodes ]
+    attempt = 0 # number of failed attempts so far
+    while retryPolicy.waitUntilAvailable( _stopping ):
+        requestStart = time.time()
+        try:
+            with tracing.span( 'request', bus = dataConverter.getBusName( siteId )):
+                response = session.get( f'{baseUrl}sites/{siteId}/datanodes', params = { 'expand': 'name,processData', 'limit': 50 }, timeout = 120 )
+                if response.status_code == 200:
+                    siteData = { name: Series() for name in names }
+                    for node in response.json()['items']:
+                        # processData has no items if the datanode has no measurements
+                        if node['name'] in siteData:
+                            siteData[ node['name'] ] = Series.fromItems( node.get( 'processData', {} ).get( 'items', [] )[ :1 ] )
+                            
+                    retryPolicy.recordSuccess()
+                    return siteData
+                
+            attempt += 1
+            retryTime = retryPolicy.getDelay( attempt )
+            log.error( f'Failed to get latest measurements from IoT-Ticket. HTTP status code: {response.status_code}. Retrying after {retryTime:.1f} seconds.' )
+            log.error( response.text )
+            
+        except:
+            attempt += 1
+            retryTime = retryPolicy.getDelay( attempt )
+            log.exception( f'Exception when getting latest measurements from IoT-Ticket. Retrying after {retryTime:.1f} seconds.')
+            
+        finally:
+            metrics.requestDuration.observe( time.time() -requestStart, endpoint = retryPolicy.name )
+            
+        retryPolicy.recordFailure()
+        _stopping.wait( retryTime )
+        
+    raise KeyboardInterrupt()
+    
+def _countFetched( data ):
+    '''
+    Internal method that adds the number of fetched measurements of each bus to the metrics.
+    '''
+    for siteId, siteData in data.items():
+        metrics.measurementsFetched.inc( sum( len( series ) for series in siteData.values() ), bus = dataConverter.getBusName( siteId ))
+    
+def _parseStream( processdata ):
+    '''
+    Internal method that parses the items of a streamed processdata response as the body arrives.
+    Returns the measurements as a Series.
+    '''
+    try:
+        # IoT-Ticket does not tell the charset but JSON is UTF-8
+        if processdata.encoding == None:
+            processdata.encoding = 'utf-8'
+            
+        return jsonStream.parseItems( processdata.iter_content( chunk_size = 65536, decode_unicode = True ))
+    
+    finally:
+        # release the connection back to the pool
+        processdata.close()
     
 def printDataStats( data ):
     '''
@@ -119,4 +614,42 @@ def printDataStats( data ):
 # read configuration for connecting to IoT-Ticket 
 conf = config.loadConfig( 'iot-ticket.json' )
 auth = ( conf['username'], conf['password'] )
-baseUrl = conf['url']
\ No newline at end of file
+baseUrl = conf['url']
+# maximum number of concurrent requests to IoT-Ticket when getting measurements
+maxRequests = conf.get( 'max_concurrent_requests', 1 )
+# worker pool that fetches the measurements of the datanodes
+executor = ThreadPoolExecutor( max_workers = maxRequests, thread_name_prefix = 'iot-ticket' )
+# session used for all requests to IoT-Ticket
+# its connection pool has a connection for each worker so that connections are kept alive between collection rounds
+session = sessions.createSession( maxRequests, auth )
+# maximum number of measurements requested at once. If a response has this many the rest are requested separately
+pageLimit = conf.get( 'page_limit', 100000 )
+# how many measurements of a datanode to aim for when prefetching. 0 means no prefetching
+prefetchTargetItems = conf.get( 'prefetch_target_items', 0 )
+# maximum length of a prefetch in microseconds
+maxPrefetch = s2mrs( conf.get( 'max_prefetch_hours', 24 ) *3600 )
+# should the latest measurements of the datanodes be probed so that datanodes without new measurements are not requested
+freshnessProbe = conf.get( 'freshness_probe', False )
+# how long it can take for a measurement to arrive to IoT-Ticket in microseconds
+arrivalMargin = s2mrs( conf.get( 'arrival_margin', 60 ))
+# timestamp of the latest measurement and when it was probed by datanode href
+_freshness = {}
+# should the datanodes be saved to a file and used from there in the next run
+useNodeCache = conf.get( 'datanode_cache', True )
+nodeCacheFile = checkpoint.stateDir / 'datanodes.json'
+# seconds after which the datanodes of a site are got again. 0 means never
+refreshInterval = conf.get( 'datanode_refresh_minutes', 60 ) *60
+# all datanodes of each site and when they were got by site id
+_siteNodes = {}
+# held when the datanodes are changed or saved
+_nodesLock = threading.Lock()
+# prefetched measurements by datanode href
+_caches = {}
+# measurements per microsecond by datanode href
+_densities = {}
+# should processdata responses be parsed incrementally as they arrive
+streamingParse = conf.get( 'streaming_parse', False )
+# how failed requests are retried
+retryPolicy = RetryPolicy( 'IoT-Ticket', conf.get( 'retry' ))
+# set when collecting is stopped so that workers retrying failed requests know to give up
+_stopping = threading.Event()
\ No newline at end of file
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Incremental parser for IoT-Ticket processdata responses.
+The measurements in the items array of the response are decoded one at a time as the response body arrives
+and saved directly to a Series. The whole body or a dictionary for each measurement is never kept in memory.
+'''
+
+import json
+
+from series import Series
+
+# used to decode single JSON values from the text
+_decoder = json.JSONDecoder()
+# JSON whitespace characters
+_whitespace = ' \t\n\r'
+
+def parseItems( chunks ):
+    '''
+    Parse the items of a processdata response.
+    Chunks is an iterable of strings that together form the response body e.g. from requests' iter_content.
+    Returns a Series containing the measurements in the order of the items.
+    Other attributes of the response are ignored.
+    '''
+    return _ItemParser( chunks ).parse()
+
+class _ItemParser():
+    '''
+    Internal class that does the parsing.
+    Keeps a buffer of the text that has not yet been parsed and reads more chunks to it when needed.
+    '''
+
+    def __init__(self, chunks ):
+        self.chunks = iter( chunks )
+        self.buffer = ''
+        # position of the next character to parse in buffer
+        self.pos = 0
+        self.series = Series()
+
+    def parse(self):
+        '''
+        Parse the whole response and return the Series.
+        '''
+        self._expect( '{' )
+        self._skipWhitespace()
+        if self._peek() == '}':
+            # empty object
+            return self.series
+
+        while True:
+            key = self._decode()
+            self._expect( ':' )
+            if key == 'items':
+                self._parseItems()
+
+            else:
+                # some other attribute we are not interested in
+                self._decode()
+
+            self._skipWhitespace()
+            if self._peek() == '}':
+                return self.series
+
+            # there has to be a comma before the next attribute
+            self._expect( ',' )
+
+    def _parseItems(self):
+        '''
+        Parse the items array adding each measurement to the series.
+        '''
+        self._expect( '[' )
+        self._skipWhitespace()
+        if self._peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            item = self._decode()
+            self.series.append( item['ts'], item['v'] )
+            self._skipWhitespace()
+            if self._peek() == ']':
+                self.pos += 1
+                return
+
+            self._expect( ',' )
+
+    def _decode(self):
+        '''
+        Decode the JSON value starting from the current position.
+        A value that ends at the end of the buffer may be incomplete e.g. a number whose last digits are in the next chunk.
+        So more text is read until the value is followed by something or there is no more text.
+        '''
+        self._skipWhitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode( self.buffer, self.pos )
+                if end < len( self.buffer ) or not self._read():
+                    self.pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+
+    def _read(self):
+        '''
+        Read the next chunk to the buffer dropping the already parsed text from it.
+        Returns False if there are no more chunks.
+        '''
+        for chunk in self.chunks:
+            if len( chunk ) == 0:
+                continue
+
+            self.buffer = self.buffer[ self.pos: ] +chunk
+            self.pos = 0
+            return True
+
+        return False
+
+    def _skipWhitespace(self):
+        '''
+        Move the position to the next non whitespace character.
+        '''
+        while True:
+            while self.pos < len( self.buffer ) and self.buffer[ self.pos ] in _whitespace:
+                self.pos += 1
+
+            if self.pos < len( self.buffer ) or not self._read():
+                return
+
+    def _peek(self):
+        '''
+        Get the character at the current position without moving past it.
+        '''
+        if self.pos >= len( self.buffer ) and not self._read():
+            raise ValueError( 'Unexpected end of processdata response.' )
+
+        return self.buffer[ self.pos ]
+
+    def _next(self):
+        '''
+        Get the character at the current position and move past it.
+        '''
+        char = self._peek()
+        self.pos += 1
+        return char
+
+    def _expect(self, char ):
+        '''
+        Check that the next non whitespace character is the given one and move past it.
+        '''
+        self._skipWhitespace()
+        if self._next() != char:
+            raise ValueError( f'Invalid processdata response. Expected {char} at {self.buffer[ self.pos -1: self.pos +20 ]}' )
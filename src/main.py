@@ -9,8 +9,9 @@ Bus collector main file. Responsible for starting the data collection.
 
 import fiware
 import iotTicket
-from collector import Collector
+import collector
 import config
+import metrics
 import utils
 
 from datetime import datetime
@@ -33,8 +34,15 @@ def main():
     
     # get start and end dates for collecting if given from config file
     startDate, endDate = _getStartAndEnd()
-    # get the list of datanodes we will be collecting measurements from
-    iotTicket.getDataNodes()
+    if collector.metricsPort != None:
+        # serve metrics about the collection for monitoring
+        metrics.startServer( collector.metricsPort, collector.metricsHost )
+        
+    if collector.collectorMode != 'replay':
+        # get the list of datanodes we will be collecting measurements from
+        # not needed when replaying archived measurements
+        iotTicket.getDataNodes()
+        
     # create FIWARE entities to Orion from the buses we collect data from if not already created
     fiware.createEntities()
     if not fiware.sendToQl:
@@ -42,7 +50,8 @@ def main():
         fiware.addSubscription()
 
     # create the collector that takes care of the actual collection process
-    myCollector = Collector( startDate, endDate )
+    # the type of the collector depends on the configured collector mode
+    myCollector = collector.collectorClass( startDate, endDate )
     try:
         # and start collecting
         myCollector.startCollecting()
@@ -69,8 +78,8 @@ def setupLogging():
     backups = conf['number_of_backups']
     sizeMb = conf['file_max_size_mb']
     size = round( sizeMb *(2**20) )
-    # directory where log files are saved
-    logDir = utils.getAppDir() /'logs'
+    # directory where log files are saved. Relative to the tool's root directory unless it is absolute
+    logDir = utils.getAppDir() /conf.get( 'log_dir', 'logs' )
     # create if not exists
     mkdir_p( logDir )
     log.setLevel( logging.DEBUG )
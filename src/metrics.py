@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Metrics about the collection process that can be served over HTTP in the Prometheus text format.
+Contains simple counter, gauge and histogram classes and the metrics the tool keeps.
+The metrics are always updated but they are served only if the metrics server is started.
+'''
+
+import math
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import logging
+
+import retryPolicy
+
+# logger for module
+log = logging.getLogger( __name__ )
+
+# all metrics in the order they were created
+_metrics = []
+
+class _Metric():
+    '''
+    Internal base class for metrics.
+    A metric has a value for each combination of its label values.
+    Instead of keeping values a metric can have a function that gets them when the metrics are served.
+    The function returns a list of label value tuple and value pairs.
+    '''
+    type = None
+
+    def __init__(self, name, description, labelNames = (), function = None ):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple( labelNames )
+        self.function = function
+        # value by label value tuple
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append( self )
+
+    def _getKey(self, labels ):
+        '''
+        Get the label value tuple of the given labels in the order of the label names.
+        '''
+        return tuple( str( labels[ name ] ) for name in self.labelNames )
+
+    def _getValues(self):
+        '''
+        Get the label value tuple and value pairs of the metric.
+        '''
+        if self.function != None:
+            return self.function()
+
+        with self._lock:
+            return list( self._values.items() )
+
+    def format(self):
+        '''
+        Get the metric in the Prometheus text format.
+        '''
+        lines = [ f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}' ]
+        for key, value in self._getValues():
+            lines.append( f'{self.name}{_formatLabels( self.labelNames, key )} {_formatValue( value )}' )
+
+        return lines
+
+class Counter( _Metric ):
+    '''
+    Metric whose value only increases e.g. number of fetched measurements.
+    '''
+    type = 'counter'
+
+    def inc(self, amount = 1, **labels ):
+        '''
+        Increase the value with the given labels by amount.
+        '''
+        key = self._getKey( labels )
+        with self._lock:
+            self._values[ key ] = self._values.get( key, 0 ) +amount
+
+class Gauge( _Metric ):
+    '''
+    Metric whose value can go up and down e.g. the length of the collection period.
+    '''
+    type = 'gauge'
+
+    def set(self, value, **labels ):
+        '''
+        Set the value with the given labels.
+        '''
+        key = self._getKey( labels )
+        with self._lock:
+            self._values[ key ] = value
+
+    def get(self, **labels ):
+        '''
+        Get the value with the given labels or None if it has not been set.
+        '''
+        with self._lock:
+            return self._values.get( self._getKey( labels ))
+
+    def items(self):
+        '''
+        Get the label value tuple and value pairs that have been set.
+        '''
+        with self._lock:
+            return list( self._values.items() )
+
+class Histogram( _Metric ):
+    '''
+    Metric that counts observed values e.g. request durations to buckets.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, description, labelNames = (), buckets = ( 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120 )):
+        super().__init__( name, description, labelNames )
+        self.buckets = tuple( buckets ) +( math.inf, )
+
+    def observe(self, value, **labels ):
+        '''
+        Add an observed value with the given labels.
+        '''
+        key = self._getKey( labels )
+        with self._lock:
+            counts, total = self._values.get( key, ( [ 0 ] *len( self.buckets ), 0 ))
+            for i, bound in enumerate( self.buckets ):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+
+            self._values[ key ] = ( counts, total +value )
+
+    def format(self):
+        lines = [ f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}' ]
+        labelNames = self.labelNames +( 'le', )
+        for key, ( counts, total ) in self._getValues():
+            cumulative = 0
+            for bound, count in zip( self.buckets, counts ):
+                cumulative += count
+                lines.append( f'{self.name}_bucket{_formatLabels( labelNames, key +( _formatValue( bound ), ))} {cumulative}' )
+
+            lines.append( f'{self.name}_sum{_formatLabels( self.labelNames, key )} {_formatValue( total )}' )
+            lines.append( f'{self.name}_count{_formatLabels( self.labelNames, key )} {cumulative}' )
+
+        return lines
+
+    def _getValues(self):
+        with self._lock:
+            # copy the counts so that they do not change while they are formatted
+            return [ ( key, ( list( counts ), total )) for key, ( counts, total ) in self._values.items() ]
+
+def formatMetrics():
+    '''
+    Get all metrics in the Prometheus text format.
+    '''
+    lines = []
+    for metric in _metrics:
+        lines.extend( metric.format() )
+
+    return '\n'.join( lines ) +'\n'
+
+def startServer( port, host = '127.0.0.1' ):
+    '''
+    Start serving the metrics from /metrics at the given port in a background thread.
+    '''
+    server = ThreadingHTTPServer( ( host, port ), _MetricsHandler )
+    server.daemon_threads = True
+    threading.Thread( target = server.serve_forever, name = 'metrics', daemon = True ).start()
+    log.info( f'Serving metrics at {host}:{port}.' )
+    return server
+
+class _MetricsHandler( BaseHTTPRequestHandler ):
+    '''
+    Internal request handler of the metrics server.
+    '''
+
+    def do_GET(self):
+        if self.path.split( '?' )[0] != '/metrics':
+            self.send_response( 404 )
+            self.send_header( 'Content-Length', '0' )
+            self.end_headers()
+            return
+
+        body = formatMetrics().encode( 'utf-8' )
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'text/plain; version=0.0.4; charset=utf-8' )
+        self.send_header( 'Content-Length', str( len( body )))
+        self.end_headers()
+        self.wfile.write( body )
+
+    def log_message(self, format, *args ):
+        # scraping happens often so do not log it
+        pass
+
+def _formatLabels( names, values ):
+    '''
+    Internal function that formats label names and values e.g. {bus="TKL14"}.
+    '''
+    if len( names ) == 0:
+        return ''
+
+    labels = []
+    for name, value in zip( names, values ):
+        value = str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+        labels.append( f'{name}="{value}"' )
+
+    return '{' +','.join( labels ) +'}'
+
+def _formatValue( value ):
+    '''
+    Internal function that formats a metric value.
+    '''
+    if value == math.inf:
+        return '+Inf'
+
+    if value == -math.inf:
+        return '-Inf'
+
+    if type( value ) == int:
+        return str( value )
+
+    return repr( float( value ))
+
+def _getLag():
+    '''
+    Internal function that gets the collection lag of each bus from the time it has been collected until.
+    '''
+    now = time.time()
+    return [ ( key, now -until ) for key, until in collectedUntil.items() ]
+
+def _getRetries():
+    '''
+    Internal function that gets the retry counts of the endpoints.
+    '''
+    return [ (( policy.name, ), policy.retries ) for policy in retryPolicy.policies ]
+
+def _getOpenCircuits():
+    '''
+    Internal function that tells which endpoints are considered to be unavailable.
+    '''
+    return [ (( policy.name, ), int( policy.isOpen() )) for policy in retryPolicy.policies ]
+
+# the metrics of the tool
+collectedUntil = Gauge( 'collector_collected_until_seconds', 'End of the last period of the bus that has been collected as a unix timestamp.', [ 'bus' ] )
+lag = Gauge( 'collector_lag_seconds', 'Seconds between now and the end of the last collected period of the bus.', [ 'bus' ], function = _getLag )
+period = Gauge( 'collector_period_seconds', 'Length of the current collection period in seconds.' )
+busPeriod = Gauge( 'collector_bus_period_seconds', 'Length of the current collection period of the bus in seconds when buses are collected separately.', [ 'bus' ] )
+measurementsFetched = Counter( 'collector_measurements_fetched_total', 'Measurements fetched from IoT-Ticket.', [ 'bus' ] )
+fetchesSkipped = Counter( 'collector_datanode_fetches_skipped_total', 'Datanode fetches skipped since the datanode had no new measurements.', [ 'bus' ] )
+measurementsConverted = Counter( 'collector_measurements_converted_total', 'Measurements converted to entity attribute updates.', [ 'bus' ] )
+updatesRejected = Counter( 'collector_updates_rejected_total', 'Entity updates rejected by FIWARE with a client error which were not sent.', [ 'bus', 'endpoint' ] )
+measurementsSent = Counter( 'collector_measurements_sent_total', 'Entity attribute updates sent to FIWARE.', [ 'bus', 'endpoint' ] )
+requestDuration = Histogram( 'collector_request_duration_seconds', 'Duration of requests to IoT-Ticket and FIWARE including failed ones.', [ 'endpoint' ] )
+retries = Counter( 'collector_retries_total', 'Retried requests.', [ 'endpoint' ], function = _getRetries )
+circuitOpen = Gauge( 'collector_circuit_open', 'Is the endpoint considered to be unavailable after failing repeatedly.', [ 'endpoint' ], function = _getOpenCircuits )
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Contains the RetryPolicy class that determines how failed requests to an endpoint such as IoT-Ticket or Orion are retried.
+'''
+
+import time
+import random
+import threading
+import logging
+
+# logger for module
+log = logging.getLogger( __name__ )
+
+# all created policies so that their state can be reported as metrics
+policies = []
+
+class RetryPolicy():
+    '''
+    Retry policy and circuit breaker for one endpoint.
+    Delay before a retry grows exponentially with each attempt up to a maximum. A random jitter is subtracted from the delay
+    so that multiple workers retrying at the same time do not all hit the endpoint at the same moment.
+    Retries are limited by a budget: each retry uses one token and each successful request gives back a fraction of a token.
+    When the budget is used up retries are done only after the maximum delay.
+    After enough consecutive failures the circuit is opened and no requests should be sent until the reset timeout has passed.
+    Then one trial request is let through. If it succeeds the circuit is closed again otherwise it stays open for another timeout.
+    Can be used from multiple threads.
+    '''
+
+    def __init__(self, name, conf = None ):
+        '''
+        Create the policy for the endpoint with the given name.
+        Conf is a dictionary with the settings from a configuration file. Missing settings have default values.
+        '''
+        if conf == None:
+            conf = {}
+
+        self.name = name
+        self.baseDelay = conf.get( 'base_delay', 2 )
+        self.maxDelay = conf.get( 'max_delay', 120 )
+        self.multiplier = conf.get( 'multiplier', 2 )
+        self.jitter = conf.get( 'jitter', 0.5 )
+        self.budgetRatio = conf.get( 'retry_budget_ratio', 0.2 )
+        self.budgetMax = conf.get( 'retry_budget_max', 20 )
+        self.failureThreshold = conf.get( 'failure_threshold', 5 )
+        self.resetTimeout = conf.get( 'reset_timeout', 60 )
+        # retry tokens available
+        self.budget = self.budgetMax
+        # number of failures since the last success
+        self.failures = 0
+        # total number of retries done
+        self.retries = 0
+        # circuit state: closed, open or half-open
+        self.state = 'closed'
+        # when an open circuit can be tried again
+        self.openUntil = 0
+        self._lock = threading.Lock()
+        policies.append( self )
+
+    def getDelay(self, attempt ):
+        '''
+        Get how long to wait in seconds before retrying after attempt failed attempts.
+        Uses a token from the retry budget.
+        '''
+        with self._lock:
+            self.retries += 1
+            if self.budget < 1:
+                # no budget left so retry slowly
+                delay = self.maxDelay
+
+            else:
+                self.budget -= 1
+                delay = min( self.baseDelay *self.multiplier **max( attempt -1, 0 ), self.maxDelay )
+
+        return delay *( 1 -self.jitter *random.random() )
+
+    def recordSuccess(self):
+        '''
+        Tell that a request succeeded.
+        '''
+        with self._lock:
+            self.budget = min( self.budget +self.budgetRatio, self.budgetMax )
+            self.failures = 0
+            if self.state != 'closed':
+                log.info( f'{self.name} is available again.' )
+                self.state = 'closed'
+
+    def recordFailure(self):
+        '''
+        Tell that a request failed.
+        Opens the circuit if there have been enough consecutive failures or the trial request of a half open circuit failed.
+        '''
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or ( self.state == 'closed' and self.failures >= self.failureThreshold ):
+                log.warning( f'{self.name} failed {self.failures} times in a row. Pausing requests for {self.resetTimeout} seconds.' )
+                self.state = 'open'
+                self.openUntil = time.time() +self.resetTimeout
+
+    def recordInconclusive(self):
+        '''
+        Tell that a request failed in a way that does not tell if the endpoint is available for example a too large request timed out.
+        Does not count as a failure but if it was the trial request of a half open circuit the next request is let through as a new trial.
+        '''
+        with self._lock:
+            if self.state == 'half-open':
+                self.state = 'open'
+                self.openUntil = time.time()
+
+    def isOpen(self):
+        '''
+        Check if the circuit is open or half open i.e. the endpoint is considered to be unavailable.
+        '''
+        return self.state != 'closed'
+
+    def waitUntilAvailable(self, stopping ):
+        '''
+        Wait until requests can be sent to the endpoint.
+        Returns immediately if the circuit is closed. If it is open waits until the reset timeout has passed.
+        Then the first caller is let through to make a trial request and others wait for its result.
+        Stopping is a threading.Event which stops the waiting when set.
+        Returns False if waiting was stopped and True otherwise.
+        '''
+        while not stopping.is_set():
+            with self._lock:
+                if self.state == 'closed':
+                    return True
+
+                waitTime = self.openUntil -time.time()
+                if self.state == 'open' and waitTime <= 0:
+                    # this caller makes the trial request
+                    self.state = 'half-open'
+                    return True
+
+                if self.state == 'half-open':
+                    # waiting for the result of the trial request
+                    waitTime = 1
+
+            stopping.wait( waitTime )
+
+        return False
+
+    def waitWhileOpen(self, stopping ):
+        '''
+        Wait while the circuit is open without making the trial request.
+        Used by those who do not send requests to the endpoint themselves but should not proceed while it is unavailable.
+        Stopping is a threading.Event which stops the waiting when set.
+        Returns False if waiting was stopped and True otherwise.
+        '''
+        if self.state == 'open':
+            log.info( f'Waiting for {self.name} to become available.' )
+
+        while self.state == 'open' and not stopping.is_set():
+            stopping.wait( 1 )
+
+        return not stopping.is_set()
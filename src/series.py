@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Contains the Series class used to hold the measurements of one datanode.
+'''
+
+from array import array
+from bisect import bisect_right
+
+class Series():
+    '''
+    Measurements of a datanode as separate timestamp and value columns.
+    Timestamps are kept in an int64 array. Values are kept in an int64 or a double array if all of them
+    are integers or all of them are floats. Otherwise they are in a list.
+    This takes a lot less memory than a dictionary for each measurement.
+    '''
+    __slots__ = ( 'timestamps', 'values' )
+
+    def __init__(self):
+        self.timestamps = array( 'q' )
+        # the value column is created when the first value is added since its type depends on the value
+        self.values = None
+
+    @classmethod
+    def fromItems( cls, items ):
+        '''
+        Create a series from a list of value (v) timestamp (ts) dictionaries e.g. IoT-Ticket processdata items.
+        '''
+        series = cls()
+        for item in items:
+            series.append( item['ts'], item['v'] )
+
+        return series
+
+    @classmethod
+    def fromColumns( cls, timestamps, values ):
+        '''
+        Create a series from existing timestamp and value columns e.g. ones loaded from the measurement archive.
+        Timestamps is an int64 array and values an array, a list or None if the series is empty.
+        '''
+        series = cls()
+        series.timestamps = timestamps
+        series.values = values
+        return series
+
+    def append(self, ts, value ):
+        '''
+        Add a measurement to the end of the series.
+        '''
+        self.timestamps.append( ts )
+        if self.values == None:
+            self.values = _createValueColumn( value )
+
+        try:
+            if type( self.values ) != list and type( value ) != _arrayTypes[ self.values.typecode ]:
+                raise TypeError( 'value does not fit the array' )
+
+            self.values.append( value )
+
+        except ( TypeError, OverflowError ):
+            # values are of different types or too big for the array so they have to be kept in a list
+            self.values = list( self.values )
+            self.values.append( value )
+
+    def extend(self, other ):
+        '''
+        Add the measurements of another series to the end of this series.
+        '''
+        if other.values == None:
+            return
+
+        self.timestamps.extend( other.timestamps )
+        if self.values == None:
+            self.values = other.values[:]
+
+        elif type( self.values ) != list and type( other.values ) != list and self.values.typecode == other.values.typecode:
+            self.values.extend( other.values )
+
+        else:
+            # values are of different types so they have to be kept in a list
+            self.values = list( self.values ) +list( other.values )
+
+    def split(self, ts ):
+        '''
+        Split the series at the given timestamp.
+        Returns a series with the measurements at or before ts and a series with the measurements after it.
+        The timestamps have to be in ascending order.
+        '''
+        index = bisect_right( self.timestamps, ts )
+        if self.values == None:
+            return Series(), Series()
+
+        before = Series.fromColumns( self.timestamps[ :index ], self.values[ :index ] )
+        after = Series.fromColumns( self.timestamps[ index: ], self.values[ index: ] )
+        return before, after
+
+    def roundTimestamps(self):
+        '''
+        Rounds the timestamps from microseconds to seconds.
+        We don't want duplicate timestamps so only the first of consecutive measurements
+        that have the same timestamp after rounding is kept.
+        '''
+        timestamps = self.timestamps
+        values = self.values
+        keep = 0 # number of measurements kept so far
+        for i in range( len( timestamps )):
+            ts = round( timestamps[i] /1000000 )
+            if keep > 0 and timestamps[ keep -1 ] == ts:
+                # same as the previous kept one so drop this
+                continue
+
+            timestamps[ keep ] = ts
+            values[ keep ] = values[i]
+            keep += 1
+
+        # drop the rest
+        del timestamps[ keep: ]
+        if values != None:
+            del values[ keep: ]
+
+    def __len__(self):
+        return len( self.timestamps )
+
+    def __iter__(self):
+        '''
+        Iterate over timestamp value tuples.
+        '''
+        if self.values == None:
+            return iter( [] )
+
+        return zip( self.timestamps, self.values )
+
+# python types of values in the value arrays by array type code
+_arrayTypes = {
+    'q': int,
+    'd': float
+}
+
+def _createValueColumn( value ):
+    '''
+    Internal function that creates an empty value column suitable for the given value.
+    '''
+    if type( value ) == int:
+        return array( 'q' )
+
+    if type( value ) == float:
+        return array( 'd' )
+
+    return []
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Helper module for creating HTTP sessions used to communicate with IoT-Ticket and FIWARE.
+A session keeps its connections open and reuses them for later requests to the same host
+so that a new TCP and TLS handshake is not needed for every request.
+'''
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# how many hosts a session keeps connection pools for
+# IoT-Ticket uses one host and FIWARE at most two (Orion and QuantumLeap) so this is plenty
+poolHosts = 10
+
+def createSession( poolSize, auth = None ):
+    '''
+    Create a session whose connection pool keeps at most poolSize connections per host open.
+    PoolSize should be the number of requests that can be done concurrently with the session
+    so that no request has to open a connection that will not be reused.
+    Auth is optional authentication used with every request of the session.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter( pool_connections = poolHosts, pool_maxsize = max( poolSize, 1 ) )
+    session.mount( 'http://', adapter )
+    session.mount( 'https://', adapter )
+    if auth != None:
+        session.auth = auth
+
+    return session
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Contains the Spool class: a local write-ahead spool for FIWARE entity updates.
+The updates of each collection period are appended to segment files on disk and sent to FIWARE by a separate drainer thread.
+Collecting can then continue while FIWARE is unavailable and the spooled updates are sent in bulk when it is available again.
+Each record in a segment is a JSON document prefixed with its length and CRC32 checksum. Segments are deleted after all
+of their updates have been sent and the drain position is saved after each send so that after a restart sending continues
+from where it was left.
+'''
+
+import json
+import os
+import struct
+import threading
+import zlib
+import logging
+
+# logger for module
+log = logging.getLogger( __name__ )
+
+# record header: length of the record body and its CRC32 checksum
+_header = struct.Struct( '>II' )
+# name of the file where the drain position is saved
+_positionFileName = 'position.json'
+
+class Spool():
+    '''
+    Write-ahead spool in a directory.
+    Collectors append updates to it and its drainer thread sends them with the given send function in the order they were appended.
+    Appending and draining can be done from different threads.
+    '''
+
+    def __init__(self, directory, send, segmentBytes = 64 *2**20, drainBatch = 10 ):
+        '''
+        Open the spool in the given directory creating it if needed.
+        Send is the function used to send a dictionary of entity updates by site id e.g. fiware.sendData.
+        SegmentBytes is the size after which a new segment file is started.
+        DrainBatch is how many spooled periods are at most merged and sent together.
+        '''
+        self.directory = directory
+        self.send = send
+        self.segmentBytes = segmentBytes
+        self.drainBatch = drainBatch
+        directory.mkdir( parents = True, exist_ok = True )
+        segments = self._listSegments()
+        # segment and offset of the next record to send
+        self._readSegment, self._readOffset = self._loadPosition( segments )
+        for segment in segments:
+            if segment < self._readSegment:
+                # everything in these was sent but they were not deleted before the tool was stopped
+                self._segmentPath( segment ).unlink()
+
+        # new records always go to a new segment so that nothing is appended after a record that was only partially written
+        self._writeSegment = max( segments[-1] +1 if len( segments ) > 0 else 0, self._readSegment )
+        # opened when the first record is appended
+        self._writeFile = None
+        # how many bytes have been written to the current write segment
+        self._writeOffset = 0
+        if self._readSegment < self._writeSegment:
+            log.info( f'{self._writeSegment -self._readSegment} spool segments with unsent updates found in {directory}.' )
+
+        # used to tell the drainer that there are new records or that it should stop
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        # set when the drainer should stop after sending everything
+        self._finishing = False
+        # set if the drainer stopped because sending failed
+        self._failed = False
+        self._thread = None
+
+    def start(self):
+        '''
+        Start the drainer thread that sends the spooled updates.
+        '''
+        self._thread = threading.Thread( target = self._drain, name = 'spool-drain', daemon = True )
+        self._thread.start()
+
+    def append(self, end, updates ):
+        '''
+        Append the updates of the collection period ending at end to the spool.
+        Returns after the updates have been written to the disk.
+        '''
+        if self._failed:
+            raise RuntimeError( 'Sending spooled updates failed.' )
+
+        body = json.dumps( { 'end': end, 'updates': updates }, separators = ( ',', ':' )).encode( 'utf-8' )
+        with self._condition:
+            if self._writeFile == None or self._writeOffset >= self.segmentBytes:
+                self._startSegment()
+
+            self._writeFile.write( _header.pack( len( body ), zlib.crc32( body )) +body )
+            self._writeFile.flush()
+            os.fsync( self._writeFile.fileno() )
+            self._writeOffset += _header.size +len( body )
+            self._condition.notify_all()
+
+    def finish(self):
+        '''
+        Wait until all spooled updates have been sent and stop the drainer.
+        '''
+        with self._condition:
+            self._finishing = True
+            self._condition.notify_all()
+
+        while self._thread.is_alive():
+            self._thread.join( 1 )
+
+        self._closeWriteFile()
+        if self._failed:
+            raise RuntimeError( 'Sending spooled updates failed.' )
+
+        if self._isDrained():
+            # everything was sent so the spool is not needed anymore
+            self._remove()
+
+    def stop(self):
+        '''
+        Stop the drainer without waiting for the spooled updates to be sent.
+        They are sent when the spool is opened again.
+        '''
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _drain(self):
+        '''
+        Drainer thread's main function.
+        Sends the spooled updates and moves the drain position past them until stopped or finished.
+        '''
+        try:
+            while True:
+                batch = self._nextBatch()
+                if batch == None:
+                    return
+
+                records, segment, offset = batch
+                if len( records ) > 1:
+                    log.debug( f'Sending {len( records )} spooled periods together.' )
+
+                self.send( _mergeRecords( records ))
+                self._advance( segment, offset )
+
+        except KeyboardInterrupt:
+            # stopped while sending so these updates are sent again next time
+            return
+
+        except:
+            log.exception( 'Sending spooled updates failed.' )
+            self._failed = True
+
+    def _nextBatch(self):
+        '''
+        Wait for spooled records and read up to drainBatch of them.
+        Returns the records and the segment and offset after them or None if the drainer should stop.
+        '''
+        while True:
+            with self._condition:
+                while self._isDrained() and not self._finishing and not self._stopping.is_set():
+                    self._condition.wait( 1 )
+
+                if self._stopping.is_set() or self._isDrained():
+                    return None
+
+                # the segment being written to is read only up to what has been written to it so far
+                writeSegment, writeOffset = self._writeSegment, self._writeOffset
+
+            records = []
+            segment, offset = self._readSegment, self._readOffset
+            while True:
+                active = segment == writeSegment
+                offset, ended = self._readRecords( segment, offset, writeOffset if active else None, records )
+                if not ended or active:
+                    break
+
+                # continue from the beginning of the next segment
+                segment += 1
+                offset = 0
+
+            if len( records ) > 0:
+                return records, segment, offset
+
+            # only moved past segments that had nothing left to send
+            self._advance( segment, offset )
+
+    def _isDrained(self):
+        '''
+        Check if everything written to the spool has been sent.
+        '''
+        return self._readSegment == self._writeSegment and self._readOffset >= self._writeOffset
+
+    def _readRecords(self, segment, offset, limit, records ):
+        '''
+        Read records from the segment starting from offset and add them to records until there are drainBatch records or the segment ends.
+        Limit is where the segment ends if it is still being written to.
+        Returns the offset after the last read record and True if the end of the segment was reached.
+        '''
+        try:
+            file = open( self._segmentPath( segment ), 'rb' )
+
+        except FileNotFoundError:
+            return offset, True
+
+        with file:
+            file.seek( offset )
+            while len( records ) < self.drainBatch:
+                if limit != None and offset >= limit:
+                    return offset, True
+
+                header = file.read( _header.size )
+                if len( header ) == 0:
+                    return offset, True
+
+                body = b''
+                if len( header ) == _header.size:
+                    length, checksum = _header.unpack( header )
+                    body = file.read( length )
+
+                if len( header ) < _header.size or len( body ) < length or zlib.crc32( body ) != checksum:
+                    # the tool was stopped while writing this record or the file is damaged
+                    log.warning( f'Skipping invalid record at {offset} in spool segment {segment}.' )
+                    return offset, True
+
+                records.append( json.loads( body.decode( 'utf-8' )))
+                offset += _header.size +length
+
+        return offset, False
+
+    def _advance(self, segment, offset ):
+        '''
+        Move the drain position to the given segment and offset and delete the segments before it.
+        '''
+        self._savePosition( segment, offset )
+        with self._condition:
+            previous = self._readSegment
+            self._readSegment, self._readOffset = segment, offset
+
+        for sent in range( previous, segment ):
+            try:
+                self._segmentPath( sent ).unlink()
+
+            except FileNotFoundError:
+                pass
+
+    def _startSegment(self):
+        '''
+        Close the current write segment and start a new one.
+        '''
+        if self._writeFile != None:
+            self._writeFile.close()
+            self._writeSegment += 1
+
+        self._writeFile = open( self._segmentPath( self._writeSegment ), 'ab' )
+        self._writeOffset = 0
+
+    def _closeWriteFile(self):
+        '''
+        Close the current write segment if there is one.
+        '''
+        with self._condition:
+            if self._writeFile != None:
+                self._writeFile.close()
+                self._writeFile = None
+
+    def _remove(self):
+        '''
+        Delete the spool's files and directory.
+        '''
+        for path in list( self.directory.glob( '*.seg' )) +[ self.directory / _positionFileName ]:
+            try:
+                path.unlink()
+
+            except FileNotFoundError:
+                pass
+
+        try:
+            self.directory.rmdir()
+
+        except OSError:
+            # something else is in the directory so leave it
+            pass
+
+    def _listSegments(self):
+        '''
+        Get the numbers of the existing segments in ascending order.
+        '''
+        return sorted( int( path.stem ) for path in self.directory.glob( '*.seg' ))
+
+    def _segmentPath(self, segment ):
+        '''
+        Get the path of the segment file with the given number.
+        '''
+        return self.directory / f'{segment:012d}.seg'
+
+    def _loadPosition(self, segments ):
+        '''
+        Get the saved drain position.
+        If there is none sending starts from the beginning of the first segment.
+        '''
+        try:
+            with open( self.directory / _positionFileName, 'r' ) as file:
+                position = json.load( file )
+                return position['segment'], position['offset']
+
+        except FileNotFoundError:
+            return ( segments[0] if len( segments ) > 0 else 0 ), 0
+
+    def _savePosition(self, segment, offset ):
+        '''
+        Save the drain position.
+        The position is first written to a temporary file which then replaces the old one so that a complete position is always available.
+        '''
+        tempPath = self.directory / ( _positionFileName +'.tmp' )
+        with open( tempPath, 'w' ) as file:
+            json.dump( { 'segment': segment, 'offset': offset }, file )
+            file.flush()
+            os.fsync( file.fileno() )
+
+        os.replace( str( tempPath ), str( self.directory / _positionFileName ))
+
+def _mergeRecords( records ):
+    '''
+    Merge the updates of spooled records to one dictionary of updates by site id.
+    The updates of a site are kept in the order of the records.
+    '''
+    updates = {}
+    for record in records:
+        for siteId, entities in record['updates'].items():
+            updates.setdefault( siteId, [] ).extend( entities )
+
+    return updates
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Tampere University
+# This software was developed as a part of the CityIoT project: https://www.cityiot.fi/english
+# This source code is licensed under the 3-clause BSD license. See license.txt in the repository root directory.
+# Author(s): Otto Hylli <otto.hylli@tuni.fi>
+'''
+Tracing and profiling of the collection.
+A span measures how long a part of the collection such as fetching the measurements of a period or converting the
+measurements of a bus takes. Spans can be written to a file as JSON lines. A cycle is one round of fetching, converting
+and sending the measurements of a period. The time spent in each span of a cycle is logged when the cycle ends and
+every Nth cycle can be profiled with cProfile.
+When tracing and profiling are off spans and cycles do nothing so they can be left in the code.
+'''
+
+import cProfile
+import json
+import os
+import threading
+import time
+import logging
+
+import config
+import utils
+
+# logger for module
+log = logging.getLogger( __name__ )
+
+class _Span():
+    '''
+    Internal class for a span that is being measured.
+    A span started inside another span in the same thread gets the attributes of its parent.
+    '''
+
+    def __init__(self, name, attributes ):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        stack = _getStack()
+        self.parent = None
+        if len( stack ) > 0:
+            self.parent = stack[-1]
+            self.attributes = { **self.parent.attributes, **self.attributes }
+
+        stack.append( self )
+        self.start = time.time()
+        self.startCounter = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback ):
+        duration = time.perf_counter() -self.startCounter
+        _getStack().pop()
+        cycle = getattr( _local, 'cycle', None )
+        if cycle != None and cycle is not self:
+            cycle.totals[ self.name ] = cycle.totals.get( self.name, 0 ) +duration
+
+        if traceFile != None:
+            record = { 'name': self.name, 'start': self.start, 'duration': duration, 'thread': threading.current_thread().name, 'pid': os.getpid() }
+            if self.parent != None:
+                record['parent'] = self.parent.name
+
+            if excType != None:
+                record['error'] = excType.__name__
+
+            record.update( self.attributes )
+            _write( record )
+
+        return False
+
+class _Cycle( _Span ):
+    '''
+    Internal class for a collection cycle.
+    Collects the total time of the spans in it that run in the same thread and profiles the cycle if it is its turn.
+    '''
+
+    def __init__(self, number, attributes ):
+        super().__init__( 'cycle', attributes )
+        self.number = number
+        self.attributes['cycle'] = number
+        # total time by span name
+        self.totals = {}
+        self.profiler = None
+
+    def __enter__(self):
+        _local.cycle = self
+        if profileEvery > 0 and self.number % profileEvery == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        return super().__enter__()
+
+    def __exit__(self, excType, excValue, traceback ):
+        super().__exit__( excType, excValue, traceback )
+        _local.cycle = None
+        if self.profiler != None:
+            self.profiler.disable()
+            profileDir.mkdir( parents = True, exist_ok = True )
+            fileName = profileDir / f'cycle-{self.number}-{os.getpid()}.prof'
+            self.profiler.dump_stats( str( fileName ))
+            log.info( f'Profile of collection cycle {self.number} saved to {fileName}.' )
+
+        if enabled:
+            totals = ', '.join( f'{name} {total:.2f} s' for name, total in self.totals.items() )
+            log.debug( f'Collection cycle {self.number} took {time.perf_counter() -self.startCounter:.2f} seconds: {totals}.' )
+
+        return False
+
+class _NoSpan():
+    '''
+    Internal class used instead of spans when tracing is off.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback ):
+        return False
+
+def span( name, **attributes ):
+    '''
+    Get a context manager that measures how long the code inside it takes.
+    Attributes are saved with the span for example the bus or period the span is about.
+    '''
+    if not enabled:
+        return _noSpan
+
+    return _Span( name, attributes )
+
+def cycle( **attributes ):
+    '''
+    Get a context manager for one collection cycle.
+    Attributes are saved with the cycle and the spans inside it.
+    '''
+    global _cycleCount
+    if not enabled and profileEvery == 0:
+        return _noSpan
+
+    with _lock:
+        _cycleCount += 1
+        number = _cycleCount
+
+    return _Cycle( number, attributes )
+
+def _getStack():
+    '''
+    Internal function that gets the spans currently being measured in this thread.
+    '''
+    stack = getattr( _local, 'stack', None )
+    if stack == None:
+        stack = []
+        _local.stack = stack
+
+    return stack
+
+def _write( record ):
+    '''
+    Internal function that writes a span to the trace file.
+    '''
+    global _file
+    line = json.dumps( record ) +'\n'
+    with _lock:
+        if _file == None:
+            traceFile.parent.mkdir( parents = True, exist_ok = True )
+            # line buffered so that spans are in the file even if the tool is stopped abruptly
+            _file = open( traceFile, 'a', buffering = 1 )
+
+        _file.write( line )
+
+# read configuration from the collector's configuration file
+conf = config.loadConfig( 'collector.json' )
+# should spans be measured
+enabled = conf.get( 'trace', False )
+# file spans are written to or None if they are not written
+traceFile = None
+if enabled and conf.get( 'trace_file' ) != None:
+    traceFile = utils.getAppDir() / conf['trace_file']
+
+# every profileEvery cycle is profiled. 0 means no profiling
+profileEvery = conf.get( 'profile_every', 0 )
+# directory where the profiles are saved
+profileDir = utils.getAppDir() / conf.get( 'profile_dir', 'logs/profiles' )
+_noSpan = _NoSpan()
+# spans and the current cycle of each thread
+_local = threading.local()
+_lock = threading.Lock()
+_cycleCount = 0
+_file = None